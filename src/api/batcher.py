@@ -0,0 +1,158 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+
+class MicroBatcher:
+    """Groups concurrent single predictions into batches.
+
+    Each call to `submit` puts its item in a queue and waits. A
+    background task takes the first waiting item, then keeps
+    collecting items for at most `max_wait_ms` milliseconds or
+    until `max_batch_size` items are gathered, awaits `predict_fn`
+    once on the whole batch and resolves every caller with its
+    own result. The prediction itself should run out of the event
+    loop (ex. in an executor): batches are dispatched without waiting
+    for the previous ones, so they run concurrently on the executor
+    while the next batch fills.
+
+    The queue lives as long as the event loop: a batcher restarted
+    after `stop` keeps the items submitted meanwhile, while the items
+    still waiting when it stops fail with a `RuntimeError`.
+
+    Args:
+        predict_fn (Callable[[List[Any]], Awaitable[Sequence[Any]]]):
+            coroutine function predicting a batch, returns one result
+            per item
+        max_batch_size (int, optional): maximum size of a batch.
+            Defaults to 32.
+        max_wait_ms (float, optional): maximum time spent collecting
+            a batch, in milliseconds. Defaults to 5.
+    """
+    def __init__(self,
+                 predict_fn: Callable[[List[Any]],
+                                      Awaitable[Sequence[Any]]],
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending = set()
+        self.n_items = 0
+        self.n_batches = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    async def submit(self, item: Any) -> Any:
+        """Queues an item and waits for its prediction
+
+        Args:
+            item (Any): the item to predict
+
+        Returns:
+            Any: the prediction of the item
+        """
+        self._ensure_started()
+        future = self._loop.create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops collecting batches. The batches already dispatched
+        are still predicted, the items waiting in the queue fail."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._queue is not None:
+            batch = []
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._fail(batch, RuntimeError("MicroBatcher stopped"))
+
+    async def _collect(self) -> List[tuple]:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self.max_wait
+        try:
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("MicroBatcher stopped"))
+            raise
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            for _, _, queued_at in batch:
+                wait = start - queued_at
+                self.wait_sum += wait
+                self.wait_max = max(self.wait_max, wait)
+            self.n_items += len(batch)
+            self.n_batches += 1
+
+            task = self._loop.create_task(self._predict(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _predict(self, batch: List[tuple]) -> None:
+        items = [item for item, _, _ in batch]
+        try:
+            results = await self.predict_fn(items)
+        except Exception as exc:
+            self._fail(batch, exc)
+            return
+        if len(results) != len(batch):
+            self._fail(batch, RuntimeError(
+                f"{len(results)} results for a batch of {len(batch)} items"))
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(batch: List[tuple], exc: Exception) -> None:
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the queue depth, the number of items and batches
+        processed and the time spent by items in the queue.
+
+        Returns:
+            Dict[str, float]: the metrics of the batcher
+        """
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "in_flight": len(self._pending),
+            "items": self.n_items,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_items / max(self.n_batches, 1),
+            "mean_wait_ms": 1000 * self.wait_sum / max(self.n_items, 1),
+            "max_wait_ms": 1000 * self.wait_max
+        }
@@ -0,0 +1,282 @@
+import click
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import coloredlogs
+import numpy as np
+import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Module run for each app, see `start_server`
+APPS = {"flask": "src.api.run", "fastapi": "src.api.run_fastapi"}
+
+logger = logging.getLogger("benchmark")
+
+
+def _read_kb(path: str, field: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_tree(pid: int) -> List[int]:
+    """Returns a process and its descendants (ex. the uvicorn
+    workers), read from /proc"""
+    children: Dict[int, List[int]] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # The command name may contain spaces, the ppid follows it
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        tree.append(current)
+        todo.extend(children.get(current, []))
+    return tree
+
+
+def memory_usage(pid: int) -> List[Dict[str, float]]:
+    """Measures the memory of a server and of its workers.
+
+    The RSS counts the shared pages (ex. memory-mapped models) in
+    every process, the PSS splits them between the processes sharing
+    them.
+
+    Args:
+        pid (int): PID of the server
+
+    Returns:
+        List[Dict[str, float]]: the PID, RSS and PSS (in MiB) of each
+            process
+    """
+    usage = []
+    for proc in process_tree(pid):
+        rss = _read_kb(f"/proc/{proc}/status", "VmRSS")
+        pss = _read_kb(f"/proc/{proc}/smaps_rollup", "Pss")
+        if rss is not None:
+            usage.append({"pid": proc,
+                          "rss_mib": rss / 1024,
+                          "pss_mib": pss / 1024 if pss is not None else None})
+    return usage
+
+
+def start_server(app_name: str, port: int, env: Dict[str, str],
+                 timeout: float = 60.0) -> subprocess.Popen:
+    """Starts an app in a subprocess and waits until it answers
+
+    Args:
+        app_name (str): `flask` or `fastapi`
+        port (int): port of the server
+        env (Dict[str, str]): environment variables of the server
+        timeout (float, optional): maximum wait in seconds.
+            Defaults to 60.
+
+    Returns:
+        subprocess.Popen: the server process
+    """
+    env = dict(os.environ, **env, PORT=str(port), HOST="127.0.0.1")
+    server = subprocess.Popen([sys.executable, "-m", APPS[app_name]],
+                              env=env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"{app_name} exited with {server.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/welcome", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError(f"{app_name} didn't start in {timeout}s")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    server.terminate()
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def replay(url: str,
+           token: str,
+           texts: List[str],
+           n_requests: int,
+           concurrency: int,
+           batch_size: int) -> Dict[str, float]:
+    """Sends requests made of the given texts, in a loop, from
+    `concurrency` threads, and measures their latency.
+
+    With a batch size of 1, the texts are sent one by one to
+    `/sentiment`, otherwise by lists to `/sentiment/batch`.
+
+    Returns:
+        Dict[str, float]: the throughput, the latency percentiles
+            (in ms) and the number of errors
+    """
+    route = "/sentiment" if batch_size == 1 else "/sentiment/batch"
+    payloads = []
+    for i in range(n_requests):
+        batch = [texts[(i * batch_size + j) % len(texts)]
+                 for j in range(batch_size)]
+        payloads.append({"token": token, "text": batch[0]}
+                        if batch_size == 1
+                        else {"token": token, "texts": batch})
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def send(payload):
+        start = time.perf_counter()
+        response = session.post(url + route, json=payload)
+        ok = response.status_code == 200 and \
+            response.json().get("Status Code", 200) == 200
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, payloads))
+    elapsed = time.perf_counter() - start
+
+    latencies = 1000 * np.array([latency for latency, _ in results])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {"requests": n_requests,
+            "errors": sum(not ok for _, ok in results),
+            "req_per_s": n_requests / elapsed,
+            "texts_per_s": n_requests * batch_size / elapsed,
+            "p50_ms": p50,
+            "p95_ms": p95,
+            "p99_ms": p99,
+            "max_ms": latencies.max()}
+
+
+def bench_app(app_name: str, port: int, env: Dict[str, str],
+              texts: List[str], token: str, n_requests: int,
+              concurrencies: List[int], batch_sizes: List[int]
+              ) -> List[Dict[str, float]]:
+    """Benchmarks an app for every concurrency and batch size"""
+    server = start_server(app_name, port, env)
+    rows = []
+    try:
+        url = f"http://127.0.0.1:{port}"
+        # Warm-up: first loads, lazy batchers...
+        replay(url, token, texts, 20, 2, 1)
+        for batch_size in batch_sizes:
+            for concurrency in concurrencies:
+                row = replay(url, token, texts, n_requests,
+                             concurrency, batch_size)
+                row.update(app=app_name, concurrency=concurrency,
+                           batch_size=batch_size)
+                memory = memory_usage(server.pid)
+                row["processes"] = len(memory)
+                row["rss_mib"] = sum(m["rss_mib"] for m in memory)
+                row["max_worker_rss_mib"] = max(m["rss_mib"] for m in memory)
+                if all(m["pss_mib"] is not None for m in memory):
+                    row["pss_mib"] = sum(m["pss_mib"] for m in memory)
+                logger.info(
+                    f"{app_name} c={concurrency} b={batch_size}: "
+                    f"{row['req_per_s']:.1f} req/s, "
+                    f"p50 {row['p50_ms']:.1f} ms, "
+                    f"p95 {row['p95_ms']:.1f} ms, "
+                    f"p99 {row['p99_ms']:.1f} ms, "
+                    f"{row['errors']} errors, "
+                    f"RSS {row['rss_mib']:.0f} MiB "
+                    f"({row['processes']} processes)")
+                rows.append(row)
+    finally:
+        stop_server(server)
+    return rows
+
+
+@click.command()
+@click.argument('csv_path', type=click.Path(exists=True),
+                default="data/processed/comments_clean.csv")
+@click.option("--app", "-a", "app_names", multiple=True,
+              type=click.Choice(list(APPS)), default=list(APPS),
+              help="Apps to benchmark (both by default)")
+@click.option("--requests", "-n", "n_requests", type=int, default=500,
+              help="Number of requests per run")
+@click.option("--concurrency", "-c", "concurrencies", multiple=True,
+              type=int, default=[1, 8, 32],
+              help="Number of concurrent clients (repeatable)")
+@click.option("--batch-size", "-b", "batch_sizes", multiple=True,
+              type=int, default=[1],
+              help="Texts per request, 1 for /sentiment (repeatable)")
+@click.option("--workers", "-w", type=int, default=1,
+              help="Number of uvicorn workers of the FastAPI app")
+@click.option("--port", "-p", type=int, default=8765)
+@click.option("--cache/--no-cache", "use_cache", default=False,
+              help="Keeps the prediction cache of the apps enabled")
+@click.option("--output", "-o", type=click.Path(), default=None,
+              help="Saves the results as JSON")
+@click.option("--max-p95-ms", type=float, default=None,
+              help="Fails if a run has a higher p95 latency")
+def main(csv_path: str,
+         app_names: List[str],
+         n_requests: int,
+         concurrencies: List[int],
+         batch_sizes: List[int],
+         workers: int = 1,
+         port: int = 8765,
+         use_cache: bool = False,
+         output: Optional[str] = None,
+         max_p95_ms: Optional[float] = None
+         ) -> None:
+    """ Starts the Flask and FastAPI apps locally (with the model and
+        token of the .env file), replays the comments of CSV_PATH to
+        them and reports the throughput, the latency percentiles and
+        the memory of their processes.
+    """
+    texts = pd.read_csv(csv_path).x.dropna().tolist()
+    token = os.environ.get("TOKEN", "")
+    env = {"WORKERS": str(workers)}
+    if not use_cache:
+        env["PREDICTION_CACHE_SIZE"] = "0"
+    logger.info(f"Replaying {len(texts)} comments from {csv_path}")
+
+    rows = []
+    for app_name in app_names:
+        rows.extend(bench_app(app_name, port, env, texts, token,
+                              n_requests, concurrencies, batch_sizes))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(rows, f, indent=4)
+        logger.info(f"Results saved at {output}")
+
+    failed = [row for row in rows if row["errors"]
+              or (max_p95_ms and row["p95_ms"] > max_p95_ms)]
+    if failed:
+        raise click.ClickException(f"{len(failed)} run(s) with errors or "
+                                   f"a p95 latency above {max_p95_ms} ms")
+
+
+if __name__ == "__main__":
+    from dotenv import find_dotenv, load_dotenv
+
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    coloredlogs.install()
+    load_dotenv(find_dotenv(usecwd=True))
+
+    main()
@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.api.config import Settings
+from src.api.registry import LoadedModel, ModelRegistry
+
+# A cached prediction: the label and, if it was asked, the score
+CachedPrediction = Tuple[str, Optional[float]]
+
+
+class PredictionCache:
+    """LRU cache of the predictions of the served models, so that
+    repeated comments (short reviews, retries...) skip the model.
+
+    A prediction is stored under the name and version of the model
+    and the normalized text (lowercased, whitespace collapsed, which
+    the cleaning of the pipelines does anyway). When the registry
+    reloads a model, the entries of its previous version are
+    dropped, see `on_reload`.
+
+    Args:
+        max_size (int, optional): maximum number of entries, the
+            least recently used ones being evicted first. 0 disables
+            the cache. Defaults to 10000.
+        ttl (Optional[float], optional): lifetime of an entry in
+            seconds. Defaults to None (no expiry).
+    """
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(text.lower().split())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self,
+                 model_name: str,
+                 version: str,
+                 texts: Sequence[str],
+                 with_scores: bool = False
+                 ) -> List[Optional[CachedPrediction]]:
+        """Looks up the predictions of texts
+
+        Args:
+            model_name (str): name of the model
+            version (str): version of the model
+            texts (Sequence[str]): the texts
+            with_scores (bool, optional): whether the scores are
+                needed: a prediction cached without score is then
+                a miss. Defaults to False.
+
+        Returns:
+            List[Optional[CachedPrediction]]: the cached predictions,
+                `None` when missing
+        """
+        now = time.monotonic()
+        results = []
+        with self._lock:
+            for text in texts:
+                key = (model_name, version, self.normalize(text))
+                entry = self._entries.get(key)
+                if entry is not None and entry[2] is not None \
+                        and entry[2] < now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None or (with_scores and entry[1] is None):
+                    self.misses += 1
+                    results.append(None)
+                    continue
+                self._entries.move_to_end(key)
+                self.hits += 1
+                results.append(entry[:2])
+        return results
+
+    def put_many(self,
+                 model_name: str,
+                 version: str,
+                 texts: Sequence[str],
+                 predictions: Sequence[CachedPrediction]) -> None:
+        """Stores the (label, score) predictions of texts"""
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            for text, (label, score) in zip(texts, predictions):
+                key = (model_name, version, self.normalize(text))
+                self._entries[key] = (label, score, expires)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, model_name: Optional[str] = None) -> int:
+        """Drops the entries of a model, or every entry
+
+        Returns:
+            int: the number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key in self._entries
+                    if model_name is None or key[0] == model_name]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def on_reload(self, loaded: LoadedModel) -> None:
+        """Listener of the registry, see `ModelRegistry.add_listener`"""
+        self.invalidate(loaded.name)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions}
+
+
+def build_prediction_cache(settings: Settings,
+                           registry: ModelRegistry) -> PredictionCache:
+    """Builds the prediction cache of an app, emptied of the entries
+    of a model whenever the registry reloads it
+
+    Args:
+        settings (Settings): settings of the app
+        registry (ModelRegistry): registry of the app
+
+    Returns:
+        PredictionCache: the cache
+    """
+    cache = PredictionCache(max_size=settings.prediction_cache_size,
+                            ttl=settings.prediction_cache_ttl)
+    registry.add_listener(cache.on_reload)
+    return cache
@@ -0,0 +1,108 @@
+import os
+from pathlib import Path
+from typing import Optional
+from dotenv import load_dotenv, find_dotenv
+
+
+class Settings:
+    """Configuration of the APIs, read from the environment
+    (and the `.env` file of the project, if any).
+
+    Relative paths are resolved against the directory of the
+    `.env` file, so the apps can be started from anywhere.
+
+    * `TOKEN`: token expected in the requests
+    * `MODEL_PATH`: the default model
+    * `MODEL_DIR`: a directory whose `*_pipe.joblib` artifacts are
+      served side by side
+    * `MODEL_CHECK_INTERVAL`: seconds between two artifact checks
+    * `MODEL_MMAP`: whether the arrays of the models are memory-mapped
+      instead of copied, so worker processes share them. The artifacts
+      must then be replaced (written aside and renamed, as
+      `src.models.serving.dump_model` does), never overwritten in place
+    * `MAX_BATCH_SIZE`: maximum number of texts of a batch request
+    * `BATCH_MAX_SIZE` / `BATCH_WINDOW_MS`: size and collection window
+      of the micro-batches of single requests
+    * `PREDICTION_CACHE_SIZE`: maximum number of cached predictions
+      (0 disables the cache)
+    * `PREDICTION_CACHE_TTL`: lifetime of a cached prediction in
+      seconds (no expiry by default)
+    * `INFERENCE_EXECUTOR`: `thread` or `process` pool for inference
+    * `INFERENCE_WORKERS`: size of the inference pool
+    * `WORKERS`: number of server processes
+    * `HOST` / `PORT`: address of the server
+    """
+    def __init__(self,
+                 token: Optional[str] = None,
+                 model_path: Optional[Path] = None,
+                 model_dir: Optional[Path] = None,
+                 model_check_interval: float = 5.0,
+                 model_mmap: bool = True,
+                 max_batch_size: int = 1000,
+                 batch_max_size: int = 32,
+                 batch_window_ms: float = 5.0,
+                 prediction_cache_size: int = 10000,
+                 prediction_cache_ttl: Optional[float] = None,
+                 inference_executor: str = "thread",
+                 inference_workers: int = 4,
+                 workers: int = 1,
+                 host: str = "0.0.0.0",
+                 port: int = 8000):
+        self.token = token
+        self.model_path = model_path
+        self.model_dir = model_dir
+        self.model_check_interval = model_check_interval
+        self.model_mmap = model_mmap
+        self.max_batch_size = max_batch_size
+        self.batch_max_size = batch_max_size
+        self.batch_window_ms = batch_window_ms
+        self.prediction_cache_size = prediction_cache_size
+        self.prediction_cache_ttl = prediction_cache_ttl
+        self.inference_executor = inference_executor
+        self.inference_workers = inference_workers
+        self.workers = workers
+        self.host = host
+        self.port = port
+
+    @classmethod
+    def from_env(cls, **defaults) -> "Settings":
+        """Reads the settings from the environment, falling back
+        on the given defaults, then on the defaults of the class.
+
+        Returns:
+            Settings: the settings of the app
+        """
+        dotenv_path = find_dotenv(usecwd=True) or find_dotenv()
+        load_dotenv(dotenv_path)
+        base_dir = Path(dotenv_path).parent if dotenv_path else Path.cwd()
+
+        def path(var):
+            value = os.environ.get(var)
+            return base_dir / value if value else defaults.get(var.lower())
+
+        def value(var, cast):
+            if var in os.environ:
+                return cast(os.environ[var])
+            return defaults.get(var.lower())
+
+        def flag(value):
+            return value.lower() in ("1", "true", "yes")
+
+        params = {
+            "token": value("TOKEN", str),
+            "model_path": path("MODEL_PATH"),
+            "model_dir": path("MODEL_DIR"),
+            "model_check_interval": value("MODEL_CHECK_INTERVAL", float),
+            "model_mmap": value("MODEL_MMAP", flag),
+            "max_batch_size": value("MAX_BATCH_SIZE", int),
+            "batch_max_size": value("BATCH_MAX_SIZE", int),
+            "batch_window_ms": value("BATCH_WINDOW_MS", float),
+            "prediction_cache_size": value("PREDICTION_CACHE_SIZE", int),
+            "prediction_cache_ttl": value("PREDICTION_CACHE_TTL", float),
+            "inference_executor": value("INFERENCE_EXECUTOR", str),
+            "inference_workers": value("INFERENCE_WORKERS", int),
+            "workers": value("WORKERS", int),
+            "host": value("HOST", str),
+            "port": value("PORT", int)
+        }
+        return cls(**{k: v for k, v in params.items() if v is not None})
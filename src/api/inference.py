@@ -0,0 +1,141 @@
+import asyncio
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from sklearn.pipeline import Pipeline
+from src.api.config import Settings
+from src.api.metrics import record_prediction
+from src.api.registry import ModelRegistry, build_registry
+
+# Registry of the processes of a process pool, see `InferencePool`
+_worker_registry: Optional[ModelRegistry] = None
+
+
+def to_label(prediction: int) -> str:
+    return "Positif" if prediction == 1 else "Négatif"
+
+
+def predict_texts(model: Any,
+                  texts: Sequence[str],
+                  with_scores: bool = False,
+                  timings: Optional[Dict[str, float]] = None
+                  ) -> Tuple[List[str], Optional[List[float]]]:
+    """Predicts a whole batch of texts with one vectorization
+    of the batch, reused for the decision scores.
+
+    The score is the decision function of the classifier if it has
+    one, the probability of the positive class otherwise.
+
+    Args:
+        model (Any): a fitted pipeline or classifier
+        texts (Sequence[str]): the texts to predict
+        with_scores (bool, optional): whether to return the
+            scores. Defaults to False.
+        timings (Optional[Dict[str, float]], optional): dict filled
+            with the durations of the `transform` (vectorization) and
+            `predict` (classification) stages. Defaults to None.
+
+    Returns:
+        Tuple[List[str], Optional[List[float]]]: the labels and
+            the scores (`None` if not asked)
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    clf = model
+    features = list(texts)
+    if isinstance(model, Pipeline):
+        clf = model.steps[-1][1]
+        features = model[:-1].transform(features)
+        timings["transform"] = time.perf_counter() - start
+        start = time.perf_counter()
+
+    predictions = [to_label(pred) for pred in clf.predict(features)]
+    scores = None
+    if with_scores and hasattr(clf, "decision_function"):
+        scores = np.ravel(clf.decision_function(features)).tolist()
+    elif with_scores:
+        scores = clf.predict_proba(features)[:, 1].tolist()
+    timings["predict"] = time.perf_counter() - start
+    return predictions, scores
+
+
+def predict_named(model_name: Optional[str],
+                  texts: Sequence[str],
+                  with_scores: bool = False,
+                  registry: Optional[ModelRegistry] = None
+                  ) -> Tuple[List[str], Optional[List[float]],
+                             Dict[str, float], str]:
+    """Fetches a model from a registry and predicts a batch of texts
+    with it. Without registry, uses the one of the current pool process.
+
+    The durations of the stages are returned along with the
+    predictions, to be recorded by the process serving the metrics,
+    and so is the version of the model which predicted: the registry
+    of a pool process checks its artifacts on its own, so it may
+    lag behind (or be ahead of) the registry of the app.
+    """
+    registry = registry or _worker_registry
+    loaded = registry.get(model_name)
+    timings = {}
+    predictions, scores = predict_texts(loaded.model, texts,
+                                        with_scores=with_scores,
+                                        timings=timings)
+    return predictions, scores, timings, loaded.version
+
+
+def _init_worker(settings: Settings) -> None:
+    global _worker_registry
+    _worker_registry = build_registry(settings)
+
+
+class InferencePool:
+    """Bounded pool running the predictions outside of the event loop.
+
+    With a thread pool, the threads share the registry of the app.
+    With a process pool, each process builds its own registry at
+    start-up; the models being memory-mapped, the processes share
+    their arrays instead of copying them.
+
+    Args:
+        registry (ModelRegistry): registry of the app
+        settings (Settings): settings of the app
+    """
+    def __init__(self, registry: ModelRegistry, settings: Settings):
+        self.registry = registry
+        self.use_processes = settings.inference_executor == "process"
+        if self.use_processes:
+            self.executor = ProcessPoolExecutor(
+                settings.inference_workers,
+                initializer=_init_worker,
+                initargs=(settings,))
+        else:
+            self.executor = ThreadPoolExecutor(
+                settings.inference_workers,
+                thread_name_prefix="inference")
+
+    async def predict(self,
+                      model_name: Optional[str],
+                      texts: Sequence[str],
+                      with_scores: bool = False
+                      ) -> Tuple[List[str], Optional[List[float]], str]:
+        """Predicts a batch of texts in the pool, see `predict_texts`
+
+        Returns:
+            Tuple[List[str], Optional[List[float]], str]: the labels,
+                the scores (`None` if not asked) and the version of
+                the model which predicted them
+        """
+        registry = None if self.use_processes else self.registry
+        loop = asyncio.get_running_loop()
+        predictions, scores, timings, version = await loop.run_in_executor(
+            self.executor,
+            partial(predict_named, model_name, list(texts),
+                    with_scores, registry))
+        record_prediction(model_name or self.registry.default,
+                          len(predictions), timings)
+        return predictions, scores, version
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,167 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: str = "") -> str:
+    labels = [f'{name}="{value}"'.replace("\n", " ")
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """Counter of events, by label values (ex. requests by status)
+
+    Args:
+        name (str): name of the metric
+        documentation (str): help text of the metric
+        label_names (Sequence[str], optional): names of the labels.
+            Defaults to no label.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {value}"
+
+
+class Histogram:
+    """Distribution of observed values (ex. durations) in cumulative
+    buckets, by label values
+
+    Args:
+        name (str): name of the metric
+        documentation (str): help text of the metric
+        label_names (Sequence[str], optional): names of the labels.
+            Defaults to no label.
+        buckets (Sequence[float], optional): upper bounds of the
+            buckets. Defaults to LATENCY_BUCKETS.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count of each bucket (+Inf last), sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observes the duration of a block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        return sum(self._values.get(key, ([], 0.0))[0])
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulated = 0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulated += count
+                labels = _format_labels(self.label_names, key,
+                                        f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {cumulated}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulated}"
+
+
+REQUESTS = Counter("sentiment_requests_total",
+                   "Requests handled, by route, method and status code",
+                   ["route", "method", "status"])
+REQUEST_LATENCY = Histogram("sentiment_request_duration_seconds",
+                            "Duration of the requests, by route",
+                            ["route", "method"])
+STAGE_LATENCY = Histogram("sentiment_stage_duration_seconds",
+                          ("Duration of the stages of a prediction: "
+                           "preprocess (parsing, validation and token check), "
+                           "transform (vectorization) and predict "
+                           "(classification)"),
+                          ["stage"])
+PREDICTED_TEXTS = Counter("sentiment_predicted_texts_total",
+                          "Texts run through a model, by model",
+                          ["model"])
+MODEL_LOAD = Histogram("sentiment_model_load_duration_seconds",
+                       "Duration of the loads of the models, by model",
+                       ["model"],
+                       buckets=(0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0,
+                                30.0, 60.0))
+
+
+def record_prediction(model_name: str, n_texts: int,
+                      timings: Dict[str, float]) -> None:
+    """Records a batch predicted by a model and the duration of its
+    stages, see `src.api.inference.predict_texts`"""
+    PREDICTED_TEXTS.inc(n_texts, model=model_name)
+    for stage, duration in timings.items():
+        STAGE_LATENCY.observe(duration, stage=stage)
+
+
+ALL_METRICS = [REQUESTS, REQUEST_LATENCY, STAGE_LATENCY, PREDICTED_TEXTS,
+               MODEL_LOAD]
+
+
+def render() -> str:
+    """Renders every metric of the process in the Prometheus text
+    exposition format. Each process (ex. each uvicorn worker) exports
+    its own metrics.
+
+    Returns:
+        str: the body of the `/metrics` response
+    """
+    lines = []
+    for metric in ALL_METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,285 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from src.api.config import Settings
+from src.api.metrics import MODEL_LOAD
+from src.models.serving import compact_files, load_model
+
+logger = logging.getLogger(__name__)
+
+
+def _artifact_files(path: Path) -> List[Path]:
+    """Files of an artifact: the file itself, or the files of the
+    current version of a compact artifact directory"""
+    if path.is_dir():
+        return compact_files(path)
+    return [path]
+
+
+def file_digest(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    """Computes the SHA-256 digest of an artifact without reading it
+    whole in memory. The digest of a directory covers the names and
+    contents of its files.
+
+    Args:
+        path (Union[str, Path]): path of the file or directory
+        chunk_size (int, optional): size of the chunks read.
+            Defaults to 1 MiB.
+
+    Returns:
+        str: hexadecimal digest
+    """
+    sha = hashlib.sha256()
+    for file_path in _artifact_files(Path(path)):
+        sha.update(file_path.name.encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def artifact_mtime(path: Union[str, Path]) -> float:
+    """Latest modification time of the files of an artifact"""
+    return max(os.stat(p).st_mtime for p in _artifact_files(Path(path)))
+
+
+class LoadedModel:
+    """A model kept in memory with the state of the file
+    it was loaded from.
+
+    Args:
+        name (str): name of the model in the registry
+        path (Path): path of the artifact
+        model (Any): the deserialized model
+        mtime (float): modification time of the artifact
+        digest (str): SHA-256 digest of the artifact
+    """
+    def __init__(self, name: str, path: Path, model: Any,
+                 mtime: float, digest: str):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.mtime = mtime
+        self.digest = digest
+        self.loaded_at = time.time()
+
+    @property
+    def version(self) -> str:
+        return self.digest[:12]
+
+    def __repr__(self):
+        return f"<LoadedModel {self.name} ({self.version})>"
+
+
+class ModelRegistry:
+    """Keeps named models resident in memory so that they are
+    deserialized once instead of at every request.
+
+    Every `check_interval` seconds, a `get` checks the artifact's
+    mtime and, if it changed, its digest. A model whose digest
+    changed is reloaded and swapped in place. While a thread checks
+    or reloads the artifacts, the other threads keep getting the
+    current model.
+
+    With `mmap_mode="r"`, the numpy arrays of the artifacts (ex. the
+    support vectors of a SVM) are memory-mapped read-only instead of
+    copied, so every process serving the same artifact shares the
+    same physical pages.
+
+    An artifact is either a joblib file or a compact directory saved
+    by `src.models.serving.save_compact`, whose vocabulary is an array
+    as well and which loads without unpickling.
+
+    A joblib artifact may also be a neural network exported by
+    `src.export_nn_model` (ex. `nn_pipe.joblib`): its TorchScript
+    module is loaded along with it and predicts on CPU.
+
+    Args:
+        check_interval (float, optional): minimum number of seconds
+            between two checks of an artifact. Defaults to 5.
+        mmap_mode (Optional[str], optional): memory-map mode given
+            to `joblib.load`. Defaults to None.
+    """
+    def __init__(self,
+                 check_interval: float = 5.0,
+                 mmap_mode: Optional[str] = None):
+        self.check_interval = check_interval
+        self.mmap_mode = mmap_mode
+        self.default: Optional[str] = None
+        self._paths: Dict[str, Path] = {}
+        self._models: Dict[str, LoadedModel] = {}
+        self._last_check: Dict[str, float] = {}
+        self._listeners: List[Callable[[LoadedModel], None]] = []
+        self._lock = threading.RLock()
+
+    def add_listener(self, listener: Callable[[LoadedModel], None]) -> None:
+        """Registers a function called with the new `LoadedModel`
+        whenever a model is reloaded (ex. to drop cached predictions)
+        """
+        self._listeners.append(listener)
+
+    def register(self,
+                 name: str,
+                 path: Union[str, Path],
+                 default: bool = False) -> None:
+        """Adds a model to the registry. The model is loaded
+        on the first call to `get` or `load_all`.
+
+        Args:
+            name (str): name under which the model is served
+            path (Union[str, Path]): path of the joblib artifact or
+                of the compact directory
+            default (bool, optional): whether the model is served
+                when no name is given. Defaults to False.
+        """
+        with self._lock:
+            self._paths[name] = Path(path)
+            self._models.pop(name, None)
+            if default or self.default is None:
+                self.default = name
+
+    def register_dir(self,
+                     model_dir: Union[str, Path],
+                     pattern: str = "*_pipe.joblib") -> List[str]:
+        """Registers every artifact of a directory matching a
+        pattern, named after the file stem (ex. `svm_pipe`).
+
+        Args:
+            model_dir (Union[str, Path]): directory of the artifacts
+            pattern (str, optional): glob pattern of the artifacts.
+                Defaults to "*_pipe.joblib".
+
+        Returns:
+            List[str]: the names of the registered models
+        """
+        names = []
+        for path in sorted(Path(model_dir).glob(pattern)):
+            self.register(path.stem, path)
+            names.append(path.stem)
+        return names
+
+    def names(self) -> List[str]:
+        return list(self._paths.keys())
+
+    def load_all(self) -> None:
+        """Loads every registered model that isn't in memory yet"""
+        for name in self.names():
+            self.get(name)
+
+    def get(self, name: Optional[str] = None) -> LoadedModel:
+        """Returns a resident model, loading or reloading it
+        if needed.
+
+        Args:
+            name (Optional[str], optional): name of the model.
+                Defaults to the default model.
+
+        Raises:
+            KeyError: if the model isn't registered
+
+        Returns:
+            LoadedModel: the model and its metadata
+        """
+        name = name or self.default
+        loaded = self.get_fresh(name)
+        if loaded is not None:
+            return loaded
+
+        loaded = self._models.get(name)
+        if loaded is None:
+            self._lock.acquire()
+        elif not self._lock.acquire(blocking=False):
+            # Another thread is checking or reloading the artifacts:
+            # the current model is served until the new one is ready
+            return loaded
+        try:
+            loaded = self._models.get(name)
+            if loaded is None or self._has_changed(loaded):
+                loaded = self._load(name)
+            self._last_check[name] = time.monotonic()
+        finally:
+            self._lock.release()
+        return loaded
+
+    def get_fresh(self, name: Optional[str] = None) -> Optional[LoadedModel]:
+        """Returns a resident model if its artifact was checked less
+        than `check_interval` seconds ago, None if `get` would check
+        (and maybe reload) it. Never blocks, so it can be called from
+        an event loop, see `src.api.run_fastapi.get_model`.
+
+        Raises:
+            KeyError: if the model isn't registered
+        """
+        name = name or self.default
+        if name not in self._paths:
+            raise KeyError(f"Unknown model: {name}")
+        loaded = self._models.get(name)
+        if (loaded is not None and time.monotonic()
+                - self._last_check.get(name, 0) < self.check_interval):
+            return loaded
+        return None
+
+    def _has_changed(self, loaded: LoadedModel) -> bool:
+        try:
+            mtime = artifact_mtime(loaded.path)
+        except (FileNotFoundError, ValueError):
+            logger.warning(f"{loaded.path} disappeared, keeping "
+                           f"{loaded.name} ({loaded.version}) in memory")
+            return False
+        if mtime == loaded.mtime:
+            return False
+        if file_digest(loaded.path) == loaded.digest:
+            loaded.mtime = mtime
+            return False
+        return True
+
+    def _load(self, name: str) -> LoadedModel:
+        path = self._paths[name]
+        start = time.perf_counter()
+        mtime = artifact_mtime(path)
+        digest = file_digest(path)
+        model = load_model(path, mmap_mode=self.mmap_mode)
+        loaded = LoadedModel(name, path, model, mtime, digest)
+        reloaded = name in self._models
+        self._models[name] = loaded
+        duration = time.perf_counter() - start
+        MODEL_LOAD.observe(duration, model=name)
+        logger.info(f"Loaded {name} ({loaded.version}) from {path} "
+                    f"in {duration:.3f}s")
+        if reloaded:
+            for listener in self._listeners:
+                listener(loaded)
+        return loaded
+
+
+def build_registry(settings: Settings) -> ModelRegistry:
+    """Builds a registry serving the default model of the settings
+    and the `*_pipe.joblib` and `*_pipe.compact` artifacts of its
+    model directory. A compact artifact takes precedence over the
+    joblib artifact of the same name.
+
+    Args:
+        settings (Settings): settings of the app
+
+    Returns:
+        ModelRegistry: the registry, with every model loaded
+    """
+    registry = ModelRegistry(
+        check_interval=settings.model_check_interval,
+        mmap_mode="r" if settings.model_mmap else None)
+
+    if settings.model_dir:
+        registry.register_dir(settings.model_dir)
+        registry.register_dir(settings.model_dir, pattern="*_pipe.compact")
+
+    if settings.model_path:
+        registry.register(Path(settings.model_path).stem,
+                          settings.model_path, default=True)
+
+    registry.load_all()
+    return registry
@@ -1,10 +1,13 @@
-import os
 import logging
+import time
 import coloredlogs
-from flask import Flask, jsonify, request
-from flask_restful import Api, Resource, fields, marshal_with
-from dotenv import load_dotenv, find_dotenv
-from joblib import load
+from flask import Flask, Response, g, jsonify, request
+from flask_restful import Api, Resource
+from src.api import metrics
+from src.api.cache import build_prediction_cache
+from src.api.config import Settings
+from src.api.inference import predict_texts
+from src.api.registry import build_registry
 
 app = Flask(__name__)
 api = Api(app)
@@ -15,14 +18,65 @@ logging.basicConfig(level=logging.INFO, format=log_fmt)
 coloredlogs.install()
 
 
-ML_MODEL = os.environ.get("MODEL_PATH")
-TOKEN = os.environ.get("TOKEN")
+settings = Settings.from_env(port=8080)
 
+TOKEN = settings.token
+MAX_BATCH_SIZE = settings.max_batch_size
 
-resource_fields = {
-    'token':   fields.String,
-    'text':    fields.String
-}
+registry = build_registry(settings)
+cache = build_prediction_cache(settings, registry)
+
+
+def predict_cached(model_name, texts, with_scores=False):
+    """Predicts a list of texts, only running the model on the texts
+    whose prediction isn't in the cache
+
+    Returns:
+        List[Tuple[str, Optional[float]]]: the label and score of
+            each text
+    """
+    loaded = registry.get(model_name)
+    results = cache.get_many(loaded.name, loaded.version, texts, with_scores)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        timings = {}
+        predictions, scores = predict_texts(loaded.model, missing_texts,
+                                            with_scores=with_scores,
+                                            timings=timings)
+        metrics.record_prediction(loaded.name, len(missing_texts), timings)
+        new = list(zip(predictions, scores or [None] * len(predictions)))
+        cache.put_many(loaded.name, loaded.version, missing_texts, new)
+        for i, result in zip(missing, new):
+            results[i] = result
+    return results
+
+
+def end_preprocess():
+    """Records the time spent since the arrival of the request
+    (parsing the JSON body, checking the fields and token) as its
+    preprocess stage"""
+    metrics.STAGE_LATENCY.observe(time.perf_counter() - g.start,
+                                  stage="preprocess")
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # The resources answer errors with a 200 and their status code
+    # in the body
+    status = response.status_code
+    if response.is_json and isinstance(response.get_json(), dict):
+        status = response.get_json().get("Status Code", status)
+    metrics.REQUESTS.inc(route=route, method=request.method, status=status)
+    metrics.REQUEST_LATENCY.observe(time.perf_counter() - g.start,
+                                    route=route, method=request.method)
+    return response
 
 
 class Welcome(Resource):
@@ -41,7 +95,6 @@ class Welcome(Resource):
 
 
 class SentimentAnalysis(Resource):
-    @marshal_with(resource_fields)
     def post(self):
         """[summary]
 
@@ -54,7 +107,7 @@ class SentimentAnalysis(Resource):
         set1 = {"token", "text"}
 
         res = set(postedData.keys())
-        if set1 != res:
+        if not set1.issubset(res):
             missing_fields = ', '.join(set1.difference(res))
             return jsonify({
                     "Message": f"{missing_fields} missing",
@@ -72,10 +125,16 @@ class SentimentAnalysis(Resource):
                     "Status Code": 401
                 })
 
-        #
-        clf_pipe = load(ML_MODEL)
-        prediction = clf_pipe.predict([text])[0]
-        prediction = "Positif" if prediction == 1 else "Négatif"
+        # Optional name of one of the served models
+        model_name = postedData.get("model")
+        if model_name and model_name not in registry.names():
+            return jsonify({
+                    "Message": f"Modèle inconnu: {model_name}",
+                    "Status Code": 404
+                })
+
+        end_preprocess()
+        prediction = predict_cached(model_name, [text])[0][0]
         app.logger.info(f"Returned prediction with '{prediction}' value")
         return jsonify({
                     "text": text,
@@ -85,9 +144,95 @@ class SentimentAnalysis(Resource):
             )
 
 
+class BatchSentimentAnalysis(Resource):
+    def post(self):
+        """Predicts a list of texts in a single pass of the model.
+        Expects `token` and `texts`, and optionally `model` and
+        `scores` to also return the decision scores.
+
+        Returns:
+            Response: one prediction per text, in order
+        """
+        postedData = request.get_json()
+
+        set1 = {"token", "texts"}
+
+        res = set(postedData.keys())
+        if not set1.issubset(res):
+            missing_fields = ', '.join(set1.difference(res))
+            return jsonify({
+                    "Message": f"{missing_fields} missing",
+                    "Status Code": 400
+                })
+
+        if postedData['token'] != TOKEN:
+            app.logger.error("Invalid token.")
+            return jsonify({
+                    "Message": "Token Invalide",
+                    "Status Code": 401
+                })
+
+        texts = postedData['texts']
+        if (not isinstance(texts, list)
+                or not all(isinstance(text, str) for text in texts)):
+            return jsonify({
+                    "Message": "texts doit être une liste de textes",
+                    "Status Code": 400
+                })
+
+        if len(texts) > MAX_BATCH_SIZE:
+            return jsonify({
+                    "Message": (f"{len(texts)} textes envoyés, "
+                                f"maximum {MAX_BATCH_SIZE}"),
+                    "Status Code": 413
+                })
+
+        model_name = postedData.get("model")
+        if model_name and model_name not in registry.names():
+            return jsonify({
+                    "Message": f"Modèle inconnu: {model_name}",
+                    "Status Code": 404
+                })
+
+        end_preprocess()
+        with_scores = postedData.get("scores", False)
+        predictions = predict_cached(model_name, texts, with_scores)
+        app.logger.info(f"Returned {len(predictions)} predictions")
+
+        results = []
+        for text, (prediction, score) in zip(texts, predictions):
+            result = {"text": text, "prediction": prediction}
+            if with_scores:
+                result["score"] = score
+            results.append(result)
+        return jsonify({
+                    "predictions": results,
+                    "Status Code": 200
+            }
+            )
+
+
+class CacheMetrics(Resource):
+    def get(self):
+        """Returns the size, hits, misses and evictions of the
+        prediction cache."""
+        return jsonify(cache.stats())
+
+
+class PrometheusMetrics(Resource):
+    def get(self):
+        """Returns the request counters, the latency histograms of the
+        requests and of the prediction stages (preprocess, transform,
+        predict) and the load durations of the models, in the
+        Prometheus text format."""
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 api.add_resource(SentimentAnalysis, "/sentiment")
+api.add_resource(BatchSentimentAnalysis, "/sentiment/batch")
 api.add_resource(Welcome, "/welcome")
+api.add_resource(CacheMetrics, "/metrics/cache")
+api.add_resource(PrometheusMetrics, "/metrics")
 
 if __name__ == "__main__":
-    load_dotenv(find_dotenv())
-    app.run(debug=False, host='0.0.0.0', port=8080)
+    app.run(debug=False, host=settings.host, port=settings.port)
@@ -1,20 +1,189 @@
-import os
+import time
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
-from dotenv import load_dotenv, find_dotenv
-from joblib import load
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import State
+from src.api.batcher import MicroBatcher
+from src.api.cache import build_prediction_cache
+from src.api.config import Settings
+from src.api.inference import InferencePool
+from src.api import metrics
+from src.api.registry import LoadedModel, build_registry
 
-# To launch the app, use `uvicorn main:app --reload`
-app = FastAPI()
+# To launch the app, use `uvicorn src.api.run_fastapi:app --workers N`
+# or run this script, which reads the number of workers from `WORKERS`
 
 
 class PostedData(BaseModel):
     token: str
     text: str
+    model: Optional[str] = None
 
 
-@app.get("/welcome")
+class Prediction(BaseModel):
+    text: str
+    prediction: str
+    status_code: int
+
+
+class PostedBatch(BaseModel):
+    token: str
+    texts: List[str]
+    model: Optional[str] = None
+    scores: bool = False
+
+
+class BatchItem(BaseModel):
+    text: str
+    prediction: str
+    score: Optional[float] = None
+
+
+class BatchPrediction(BaseModel):
+    predictions: List[BatchItem]
+    status_code: int
+
+
+router = APIRouter()
+
+
+def check_request(request: Request, token: str, model_name: Optional[str]):
+    """Checks the token and the model of a request, then records the
+    time spent since its arrival (reading, parsing and validating the
+    JSON body, checking the request) as its preprocess stage"""
+    state = request.app.state
+    if token != state.settings.token:
+        raise HTTPException(status_code=401, detail="Token invalide")
+
+    if model_name and model_name not in state.registry.names():
+        raise HTTPException(status_code=404,
+                            detail=f"Modèle inconnu: {model_name}")
+
+    metrics.STAGE_LATENCY.observe(
+        time.perf_counter() - request.state.start, stage="preprocess")
+
+
+def route_path(scope: dict) -> str:
+    """Path template of the route of a request (ex. `/sentiment`),
+    `unmatched` when no route matched"""
+    endpoint = scope.get("endpoint")
+    for route in scope["app"].routes:
+        if endpoint is not None and getattr(route, "endpoint",
+                                            None) is endpoint:
+            return route.path
+    return "unmatched"
+
+
+class RequestMetrics:
+    """ASGI middleware recording the duration and status code of each
+    request. The arrival time of the request is kept in its state, see
+    `check_request`."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        scope.setdefault("state", {})["start"] = start
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            path = route_path(scope)
+            metrics.REQUESTS.inc(route=path, method=scope["method"],
+                                 status=status)
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - start,
+                                            route=path,
+                                            method=scope["method"])
+
+
+def get_batcher(state: State,
+                model_name: Optional[str] = None) -> MicroBatcher:
+    """Returns the micro-batcher of a model, grouping the
+    concurrent `/sentiment` requests sent to it.
+
+    Args:
+        state (State): state of the app
+        model_name (Optional[str], optional): name of the model.
+            Defaults to the default model.
+
+    Returns:
+        MicroBatcher: the batcher of the model, whose results are the
+            label and the version of the model which predicted it
+    """
+    name = model_name or state.registry.default
+    if name not in state.batchers:
+        async def predict_batch(texts):
+            predictions, _, version = await state.pool.predict(name, texts)
+            return [(prediction, version) for prediction in predictions]
+
+        state.batchers[name] = MicroBatcher(
+            predict_batch,
+            max_batch_size=state.settings.batch_max_size,
+            max_wait_ms=state.settings.batch_window_ms)
+    return state.batchers[name]
+
+
+async def get_model(state: State,
+                    model_name: Optional[str] = None) -> LoadedModel:
+    """Returns a model of the registry. When its artifact is due for a
+    check, the check (hashing and maybe loading the artifact) runs in
+    a thread, so that it doesn't stall the event loop.
+
+    Args:
+        state (State): state of the app
+        model_name (Optional[str], optional): name of the model.
+            Defaults to the default model.
+
+    Returns:
+        LoadedModel: the model and its metadata
+    """
+    loaded = state.registry.get_fresh(model_name)
+    if loaded is None:
+        loaded = await run_in_threadpool(state.registry.get, model_name)
+    return loaded
+
+
+async def predict_cached(state: State,
+                         model_name: Optional[str],
+                         texts: List[str],
+                         with_scores: bool = False):
+    """Predicts a list of texts, only running the model on the texts
+    whose prediction isn't in the cache of the app. New predictions
+    are cached under the version of the model which made them.
+
+    Returns:
+        List[Tuple[str, Optional[float]]]: the label and score of
+            each text
+    """
+    loaded = await get_model(state, model_name)
+    results = state.cache.get_many(loaded.name, loaded.version, texts,
+                                   with_scores)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        predictions, scores, version = await state.pool.predict(
+            loaded.name, missing_texts, with_scores=with_scores)
+        new = list(zip(predictions, scores or [None] * len(predictions)))
+        state.cache.put_many(loaded.name, version, missing_texts, new)
+        for i, result in zip(missing, new):
+            results[i] = result
+    return results
+
+
+@router.get("/welcome")
 def welcome():
     """Greets the user with a message
 
@@ -26,38 +195,139 @@ def welcome():
                     "algorithm d'analyse de sentiment")}
 
 
-@app.post("/sentiment",
-          response_model=PostedData,
-          summary="Returns SenAna prediction")
-def return_prediction(posted_data: PostedData):
+@router.post("/sentiment",
+             response_model=Prediction,
+             summary="Returns SenAna prediction")
+async def return_prediction(posted_data: PostedData, request: Request):
     """
     Uses the best model with the information given to return
     a prediction. Only accepts French comments for maximum
-    results.
+    results. Concurrent requests are predicted together, in
+    batches of at most `BATCH_MAX_SIZE` texts collected during
+    `BATCH_WINDOW_MS` milliseconds. Texts already predicted by
+    the same version of the model are answered from the cache.
+
+    The optional `model` field picks one of the served models
+    (ex. `svm_pipe`), the default model is used otherwise.
 
     - **text**: the original message from your posted data
     - **prediction**: whether your comment is positive or negative
     - **status_code**: the status code of the response
     """
+    state = request.app.state
     pd_dict = posted_data.dict()
+    check_request(request, pd_dict["token"], pd_dict["model"])
 
-    if pd_dict["token"] != TOKEN:
-        raise HTTPException(status_code=401, detail="Token invalide")
-
-    clf_pipe = load(ML_MODEL)
-    prediction = clf_pipe.predict([pd_dict["text"]])[0]
-    prediction = "Positif" if prediction == 1 else "Négatif"
+    loaded = await get_model(state, pd_dict["model"])
+    text = [pd_dict["text"]]
+    cached = state.cache.get_many(loaded.name, loaded.version, text)[0]
+    if cached is not None:
+        prediction = cached[0]
+    else:
+        batcher = get_batcher(state, loaded.name)
+        prediction, version = await batcher.submit(pd_dict["text"])
+        state.cache.put_many(loaded.name, version, text,
+                             [(prediction, None)])
 
     return {"text": pd_dict["text"],
             "prediction": prediction,
             "status_code": 200}
 
 
-if __name__ == "__main__":
-    load_dotenv(find_dotenv())
+@router.post("/sentiment/batch",
+             response_model=BatchPrediction,
+             response_model_exclude_none=True,
+             summary="Returns SenAna predictions for a list of texts")
+async def return_batch_prediction(posted_batch: PostedBatch,
+                                  request: Request):
+    """
+    Predicts a whole list of texts in a single pass of the model.
+    At most `MAX_BATCH_SIZE` texts are accepted per request.
+
+    - **predictions**: the text and prediction of each comment, in
+    order, with its decision score if `scores` is true
+    - **status_code**: the status code of the response
+    """
+    state = request.app.state
+    check_request(request, posted_batch.token, posted_batch.model)
+
+    texts = posted_batch.texts
+    max_batch_size = state.settings.max_batch_size
+    if len(texts) > max_batch_size:
+        raise HTTPException(status_code=413,
+                            detail=(f"{len(texts)} textes envoyés, "
+                                    f"maximum {max_batch_size}"))
+
+    results = await predict_cached(state, posted_batch.model, texts,
+                                   with_scores=posted_batch.scores)
+
+    return {"predictions": [{"text": text, "prediction": pred, "score": sc}
+                            for text, (pred, sc) in zip(texts, results)],
+            "status_code": 200}
 
-    ML_MODEL = os.environ.get("MODEL_PATH")
-    TOKEN = os.environ.get("TOKEN")
 
-    uvicorn.run(app, host="0.0.0.0", port=8000,
-                log_level="info")
+@router.get("/metrics/batcher")
+def batcher_metrics(request: Request):
+    """Returns, for each model, the queue depth of its batcher,
+    the number of items and batches predicted and the time spent
+    by the items in the queue."""
+    return {name: batcher.stats()
+            for name, batcher in request.app.state.batchers.items()}
+
+
+@router.get("/metrics")
+def prometheus_metrics():
+    """Returns the request counters, the latency histograms of the
+    requests and of the prediction stages (preprocess, transform,
+    predict) and the load durations of the models, in the Prometheus
+    text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@router.get("/metrics/cache")
+def cache_metrics(request: Request):
+    """Returns the size, hits, misses and evictions of the
+    prediction cache."""
+    return request.app.state.cache.stats()
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """Creates the sentiment analysis app. The models are loaded
+    when the app is created, and the predictions run in a bounded
+    inference pool so that the event loop never blocks on them.
+
+    Args:
+        settings (Optional[Settings], optional): settings of the app.
+            Defaults to the settings read from the environment.
+
+    Returns:
+        FastAPI: the app
+    """
+    settings = settings or Settings.from_env()
+
+    app = FastAPI()
+    app.state.settings = settings
+    app.state.registry = build_registry(settings)
+    app.state.cache = build_prediction_cache(settings, app.state.registry)
+    app.state.pool = InferencePool(app.state.registry, settings)
+    app.state.batchers = {}
+
+    async def stop_inference():
+        for batcher in app.state.batchers.values():
+            await batcher.stop()
+        app.state.pool.shutdown()
+
+    app.add_event_handler("shutdown", stop_inference)
+    app.add_middleware(RequestMetrics)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    settings = app.state.settings
+    uvicorn.run("src.api.run_fastapi:app",
+                host=settings.host, port=settings.port,
+                workers=settings.workers, log_level="info")
@@ -0,0 +1,89 @@
+import asyncio
+import time
+import pytest
+from .batcher import MicroBatcher
+
+
+def make_batcher(batch_sizes=None, **kwargs):
+    async def predict(items):
+        if batch_sizes is not None:
+            batch_sizes.append(len(items))
+        return [2 * item for item in items]
+
+    return MicroBatcher(predict, **kwargs)
+
+
+def test_grouping():
+    batch_sizes = []
+
+    async def run():
+        batcher = make_batcher(batch_sizes, max_batch_size=4,
+                               max_wait_ms=50)
+        results = await asyncio.gather(*[batcher.submit(i)
+                                         for i in range(6)])
+        await batcher.stop()
+        return results, batcher.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [2 * i for i in range(6)]
+    assert batch_sizes == [4, 2]
+    assert stats["batches"] == 2 and stats["items"] == 6
+
+
+def test_window_timeout():
+    batch_sizes = []
+
+    async def run():
+        batcher = make_batcher(batch_sizes, max_batch_size=100,
+                               max_wait_ms=20)
+        start = time.perf_counter()
+        first = await batcher.submit(1)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.05)
+        second = await batcher.submit(2)
+        await batcher.stop()
+        return first, second, elapsed
+
+    first, second, elapsed = asyncio.run(run())
+    assert (first, second) == (2, 4)
+    # A lone item is predicted after the window, not a full batch
+    assert elapsed < 1
+    assert batch_sizes == [1, 1]
+
+
+def test_errors():
+    async def failing(items):
+        raise ValueError("model unavailable")
+
+    async def too_few(items):
+        return items[:1]
+
+    async def run(predict_fn):
+        batcher = MicroBatcher(predict_fn, max_wait_ms=20)
+        results = await asyncio.wait_for(
+            asyncio.gather(*[batcher.submit(i) for i in range(3)],
+                           return_exceptions=True), 5)
+        await batcher.stop()
+        return results
+
+    assert all(isinstance(result, ValueError)
+               for result in asyncio.run(run(failing)))
+    assert all(isinstance(result, RuntimeError)
+               for result in asyncio.run(run(too_few)))
+
+
+def test_stop_restart():
+    async def run():
+        batcher = make_batcher(max_batch_size=10, max_wait_ms=1000)
+        assert await batcher.submit(1) == 2
+        waiting = [asyncio.ensure_future(batcher.submit(i))
+                   for i in range(3)]
+        await asyncio.sleep(0.01)
+        await batcher.stop()
+        for future in waiting:
+            with pytest.raises(RuntimeError):
+                await future
+        # The batcher restarts on the next item
+        return await asyncio.wait_for(batcher.submit(5), 5)
+
+    assert asyncio.run(run()) == 10
@@ -0,0 +1,55 @@
+import asyncio
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from starlette.datastructures import State
+from src.models.serving import dump_model
+from .cache import PredictionCache
+from .config import Settings
+from .inference import InferencePool, predict_named
+from .registry import ModelRegistry
+from .run_fastapi import predict_cached
+
+texts = ["super resto", "plat delicieux", "service lent", "cafe froid",
+         "tres bon accueil", "mauvais plat", "bon dessert", "lent et froid"]
+labels = [1, 1, 0, 0, 1, 0, 1, 0]
+
+
+def fit_model(flipped: bool = False):
+    y = [1 - label for label in labels] if flipped else labels
+    model = make_pipeline(TfidfVectorizer(), LogisticRegression())
+    return model.fit(texts, y)
+
+
+def test_cache_keyed_on_predicting_version(tmp_path):
+    path = tmp_path / "lr_pipe.joblib"
+    dump_model(fit_model(), path)
+    # The registry of the app checks its artifact at every `get`, the
+    # one of the pool (ex. a pool process) hasn't checked it yet
+    registry = ModelRegistry(check_interval=0)
+    pool_registry = ModelRegistry(check_interval=3600)
+    for reg in (registry, pool_registry):
+        reg.register("lr_pipe", path)
+    old_version = pool_registry.get().version
+
+    dump_model(fit_model(flipped=True), path)
+    new_version = registry.get().version
+    assert new_version != old_version
+
+    predictions, _, _, version = predict_named(None, texts[:2],
+                                               registry=pool_registry)
+    assert version == old_version
+    assert predictions == ["Positif", "Positif"]
+
+    state = State()
+    state.registry = registry
+    state.cache = PredictionCache()
+    state.pool = InferencePool(pool_registry, Settings(inference_workers=1))
+    try:
+        asyncio.run(predict_cached(state, None, texts[:2]))
+    finally:
+        state.pool.shutdown()
+    assert state.cache.get_many("lr_pipe", new_version, texts[:2]) == \
+        [None, None]
+    assert state.cache.get_many("lr_pipe", old_version, texts[:2]) == \
+        [("Positif", None)] * 2
@@ -0,0 +1,69 @@
+import os
+import threading
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from src.models.serving import dump_model
+from . import registry as registry_module
+from .registry import ModelRegistry
+
+texts = ["super resto", "plat delicieux", "service lent", "cafe froid",
+         "tres bon accueil", "mauvais plat", "bon dessert", "lent et froid"]
+labels = [1, 1, 0, 0, 1, 0, 1, 0]
+
+
+def fit_model(flipped: bool = False):
+    y = [1 - label for label in labels] if flipped else labels
+    model = make_pipeline(TfidfVectorizer(), LogisticRegression())
+    return model.fit(texts, y)
+
+
+def test_hot_reload(tmp_path):
+    path = tmp_path / "lr_pipe.joblib"
+    dump_model(fit_model(), path)
+    registry = ModelRegistry(check_interval=0)
+    registry.register("lr_pipe", path)
+    reloaded = []
+    registry.add_listener(reloaded.append)
+    loaded = registry.get()
+    assert registry.get() is loaded
+
+    # A new mtime with the same content isn't a new version
+    os.utime(path, (1, 1))
+    assert registry.get() is loaded
+    assert loaded.mtime == 1 and not reloaded
+
+    dump_model(fit_model(flipped=True), path)
+    new = registry.get()
+    assert new.version != loaded.version
+    assert reloaded == [new]
+    assert list(new.model.predict(texts)) == [1 - label for label in labels]
+
+
+def test_serves_current_model_during_reload(tmp_path, monkeypatch):
+    path = tmp_path / "lr_pipe.joblib"
+    dump_model(fit_model(), path)
+    registry = ModelRegistry(check_interval=0)
+    registry.register("lr_pipe", path)
+    loaded = registry.get()
+
+    loading, release = threading.Event(), threading.Event()
+    load_model = registry_module.load_model
+
+    def slow_load(*args, **kwargs):
+        loading.set()
+        release.wait(5)
+        return load_model(*args, **kwargs)
+
+    monkeypatch.setattr(registry_module, "load_model", slow_load)
+    dump_model(fit_model(flipped=True), path)
+    reloader = threading.Thread(target=registry.get)
+    reloader.start()
+    try:
+        assert loading.wait(5)
+        # Another thread is reloading: the current model is served
+        assert registry.get() is loaded
+    finally:
+        release.set()
+        reloader.join()
+    assert registry.get().version != loaded.version
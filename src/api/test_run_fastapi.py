@@ -39,3 +39,48 @@ def test_return_prediction_bad_token():
         "text": "C'est un super resto!"
     })
     assert response.status_code == 401
+
+
+def test_return_batch_prediction():
+    texts = ["C'est un super resto!", "Service lent et plats froids."]
+    response = client.post("/sentiment/batch", json={
+        "token": TOKEN,
+        "texts": texts,
+        "scores": True
+    })
+    assert response.status_code == 200
+    predictions = response.json()["predictions"]
+    assert [pred["text"] for pred in predictions] == texts
+    assert all(sorted(pred.keys()) == ["prediction", "score", "text"]
+               for pred in predictions)
+
+
+def test_return_batch_prediction_too_large():
+    max_batch_size = app.state.settings.max_batch_size
+    response = client.post("/sentiment/batch", json={
+        "token": TOKEN,
+        "texts": ["C'est un super resto!"] * (max_batch_size + 1)
+    })
+    assert response.status_code == 413
+
+
+def test_prediction_cache():
+    texts = ["Un resto vraiment au top", "UN resto  vraiment au top"]
+    hits = client.get("/metrics/cache").json()["hits"]
+    responses = [client.post("/sentiment/batch", json={
+        "token": TOKEN,
+        "texts": [text]
+    }).json()["predictions"] for text in texts]
+    assert responses[0][0]["prediction"] == responses[1][0]["prediction"]
+    assert client.get("/metrics/cache").json()["hits"] == hits + 1
+
+
+def test_metrics():
+    client.post("/sentiment/batch", json={"token": TOKEN, "texts": ["Top"]})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert ('sentiment_requests_total{route="/sentiment/batch",'
+            'method="POST",status="200"}') in response.text
+    for stage in ["preprocess", "transform", "predict"]:
+        assert (f'sentiment_stage_duration_seconds_count{{stage="{stage}"}}'
+                in response.text)
@@ -0,0 +1,85 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
+
+
+class CleanCache:
+    """Persistent cache of cleaned comments, stored in SQLite.
+
+    A comment is looked up by a hash of its raw text keyed by the
+    fingerprint of the cleaner (stopwords, stemmer pattern...), so a
+    comment is only cleaned again if it changed. When the cache is
+    opened with another fingerprint than the one it was filled with,
+    its entries are dropped.
+
+    Args:
+        path (Union[str, Path]): the SQLite file
+        fingerprint (str): fingerprint of the cleaner
+    """
+    # Maximum number of variables of a SQLite query
+    MAX_VARS = 900
+
+    def __init__(self, path: Union[str, Path], fingerprint: str):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self._hash_key = bytes.fromhex(fingerprint)[:64]
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cleaned "
+                          "(hash BLOB PRIMARY KEY, clean TEXT)")
+        row = self.conn.execute("SELECT value FROM meta "
+                                "WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            self.invalidated = row is not None
+            with self.conn:
+                self.conn.execute("DELETE FROM cleaned")
+                self.conn.execute("INSERT OR REPLACE INTO meta "
+                                  "VALUES ('fingerprint', ?)",
+                                  (fingerprint,))
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM cleaned").fetchone()[0]
+
+    def keys(self, texts: Iterable[str]) -> List[bytes]:
+        """Hashes raw texts into cache keys"""
+        return [hashlib.blake2b(txt.encode('utf-8'), digest_size=16,
+                                key=self._hash_key).digest()
+                for txt in texts]
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[str]]:
+        """Looks up the cleaned texts of a list of keys
+
+        Args:
+            keys (List[bytes]): keys computed by `keys`
+
+        Returns:
+            List[Optional[str]]: the cleaned texts, `None` when missing
+        """
+        found = {}
+        for i in range(0, len(keys), self.MAX_VARS):
+            batch = keys[i:i + self.MAX_VARS]
+            query = ("SELECT hash, clean FROM cleaned WHERE hash IN "
+                     f"({', '.join('?' * len(batch))})")
+            found.update(self.conn.execute(query, batch).fetchall())
+
+        cleaned = [found.get(key) for key in keys]
+        n_hits = len(keys) - cleaned.count(None)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        return cleaned
+
+    def put_many(self, entries: Iterable[Tuple[bytes, str]]) -> None:
+        """Stores (key, cleaned text) pairs"""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO cleaned "
+                                  "VALUES (?, ?)", entries)
+
+    def close(self) -> None:
+        self.conn.close()
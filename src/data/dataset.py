@@ -1,36 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import torch
 from torch.utils.data import Dataset, Subset, DataLoader, random_split
-from typing import Tuple, Iterable, Union
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
+from typing import List, Optional, Tuple, Iterable, Union
+from joblib import dump, load
+from joblib import hash as joblib_hash
+from sklearn.base import BaseEstimator
 from sklearn.feature_extraction.text import TfidfVectorizer
+from src.features.build_features import HashingTfidf
 from pathlib import Path
 
 
+def features_key(csv_name: Union[str, Path],
+                 vectorizer: BaseEstimator) -> str:
+    """Hashes the content of a CSV and the parameters of an unfitted
+    vectorizer, the key of their features in a cache"""
+    sha = hashlib.sha256(joblib_hash(vectorizer).encode("utf-8"))
+    with open(csv_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def csr_to_tensor(X: sp.csr_matrix) -> torch.Tensor:
+    """Wraps a scipy CSR matrix into a torch sparse CSR tensor
+    sharing its buffers (no copy).
+
+    Args:
+        X (sp.csr_matrix): the matrix
+
+    Returns:
+        torch.Tensor: the tensor, with a `torch.sparse_csr` layout
+    """
+    return torch.sparse_csr_tensor(torch.from_numpy(X.indptr),
+                                   torch.from_numpy(X.indices),
+                                   torch.from_numpy(X.data),
+                                   size=X.shape)
+
+
 class CommentDataset(Dataset):
     """Dataset taking a CSV of comments
     with an analysis attached
 
+    The fitted vectorizer is kept as `vectorizer`, to vectorize the
+    comments predicted by the trained model.
+
+    The TF-IDF features are kept as a float32 scipy CSR matrix, so
+    the memory used scales with the number of nonzeros instead of
+    the size of the vocabulary.
+
+    A single item is a dense row. A batch of items (the way a
+    `DataLoader` fetches them) is sliced from the CSR matrix in one
+    operation and returned as a sparse CSR tensor, or as a dense
+    tensor with `dense_batches`. Use `collate_batch` as the
+    `collate_fn` of the loaders, see `get_dataloaders`.
+
     Args:
         csv_name (Union[str, Path]): the filename of
             the CSV. Must have `x` as a column with
             the comments and `y` as the column with
             the labels.
+        dense_batches (bool, optional): whether the batches are
+            densified. Defaults to False.
+        vectorizer (str, optional): `tfidf` for a learned vocabulary,
+            or `hashing` for hashed words, so that the number of
+            features is `n_features` whatever the corpus.
+            Defaults to "tfidf".
+        n_features (int, optional): number of features of the hashing
+            vectorizer. Defaults to 2**14.
+        cache_dir (Optional[Union[str, Path]], optional): directory
+            where the fitted vectorizer, the features and the labels
+            are saved, under a hash of the CSV content and of the
+            vectorizer parameters, to be loaded instead of computed
+            by the next datasets of the same CSV. Defaults to None.
     """
-    def __init__(self, csv_name: Union[str, Path]):
-        df = pd.read_csv(csv_name)
+    def __init__(self, csv_name: Union[str, Path],
+                 dense_batches: bool = False,
+                 vectorizer: str = "tfidf",
+                 n_features: int = 2 ** 14,
+                 cache_dir: Optional[Union[str, Path]] = None):
+        if vectorizer == "hashing":
+            vect = HashingTfidf(n_features=n_features, dtype=np.float32)
+        else:
+            vect = TfidfVectorizer(dtype=np.float32)
+        self.dense_batches = dense_batches
+        self.cache_path = None
+        if cache_dir is not None:
+            key = features_key(csv_name, vect)
+            self.cache_path = (Path(cache_dir)
+                               / f"{Path(csv_name).stem}-{key[:16]}")
+            if self.cache_path.exists():
+                self.load(self.cache_path)
+                return
 
+        df = pd.read_csv(csv_name)
         self.labels = sorted(df.y.unique().tolist())
-        X = TfidfVectorizer().fit_transform(df.x.values)
+        X = vect.fit_transform(df.x.values)
+        self.vectorizer = vect
         y = df.y.apply(lambda x: self.labels.index(x)).values
 
-        self.X = torch.from_numpy(X.toarray()).float().to_sparse()
+        self.X = X.tocsr()
         self.y = torch.from_numpy(y).long()
+        if self.cache_path is not None:
+            self.save(self.cache_path)
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Saves the features (`X.npz`), the labels (`y.npy` and
+        `labels.json`) and the fitted vectorizer of the dataset in a
+        directory, written atomically"""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        sp.save_npz(tmp_path / "X.npz", self.X, compressed=False)
+        np.save(tmp_path / "y.npy", self.y.numpy())
+        with open(tmp_path / "labels.json", "w") as f:
+            json.dump(self.labels, f)
+        dump(self.vectorizer, tmp_path / "vectorizer.joblib")
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Already saved by another process (ex. distributed
+            # training)
+            shutil.rmtree(tmp_path)
+
+    def load(self, path: Union[str, Path]) -> None:
+        """Loads the features, labels and vectorizer saved by `save`"""
+        path = Path(path)
+        self.X = sp.load_npz(path / "X.npz").tocsr()
+        self.y = torch.from_numpy(np.load(path / "y.npy")).long()
+        with open(path / "labels.json") as f:
+            self.labels = json.load(f)
+        self.vectorizer = load(path / "vectorizer.joblib")
+
+    @property
+    def n_features(self) -> int:
+        return self.X.shape[1]
 
     def __len__(self):
         return self.y.shape[0]
 
     def __getitem__(self, idx):
-        return self.X[idx], self.y[idx]
+        row = torch.from_numpy(self.X[idx].toarray()).squeeze(0)
+        return row, self.y[idx]
+
+    def __getitems__(self, indices: List[int]
+                     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        X = self.X[indices]
+        if self.dense_batches:
+            X = torch.from_numpy(X.toarray())
+        else:
+            X = csr_to_tensor(X)
+        return X, self.y[indices]
 
     def __repr__(self):
         fmt_str = ["Comment dataset for sentiment analysis."]
@@ -61,9 +188,23 @@ def split_dataset(ds: Dataset,
     return train_ds, val_ds
 
 
+def collate_batch(batch):
+    """Collate function of the loaders of a `CommentDataset`. The
+    batches built by `CommentDataset.__getitems__` are used as is,
+    lists of items are collated by default.
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+
 def get_dataloaders(ds: Dataset,
                     bs: Iterable,
-                    train_size: float = 0.8
+                    train_size: float = 0.8,
+                    num_workers: int = 0,
+                    pin_memory: bool = False,
+                    rank: int = 0,
+                    world_size: int = 1
                     ) -> Tuple[DataLoader, DataLoader]:
     """Function splitting a dataset into a train and validation
     loader ready for model fitting.
@@ -73,6 +214,17 @@ def get_dataloaders(ds: Dataset,
         bs (Iterable): a list or tuple of a train and val batch sizes
         train_size (float, optional): The number of samples or the
             proportion of the dataset. Defaults to 0.8.
+        num_workers (int, optional): number of processes preparing
+            the next batches. Defaults to 0.
+        pin_memory (bool, optional): whether the batches are put in
+            pinned memory, for faster copies to the GPU.
+            Defaults to False.
+        rank (int, optional): rank of the process in distributed
+            training. Defaults to 0.
+        world_size (int, optional): number of processes in
+            distributed training, each one loading its own shard of
+            the sets. The split must be the same in every process
+            (same seed). Defaults to 1.
 
     Returns:
         Tuple[DataLoader, DataLoader]: The training and validation
@@ -80,6 +232,19 @@ def get_dataloaders(ds: Dataset,
     """
     train_bs, val_bs = bs
     train_ds, val_ds = split_dataset(ds, train_size=train_size)
-    train_dl = DataLoader(train_ds, batch_size=train_bs)
-    val_dl = DataLoader(val_ds, batch_size=val_bs)
+    loader_kwargs = {"collate_fn": collate_batch,
+                     "num_workers": num_workers,
+                     "pin_memory": pin_memory,
+                     "persistent_workers": num_workers > 0}
+    train_sampler = None
+    if world_size > 1:
+        # The training shards are padded to the same number of
+        # batches, which the gradient synchronization needs, while
+        # every validation comment is evaluated once
+        train_sampler = DistributedSampler(train_ds, world_size, rank,
+                                           shuffle=False)
+        val_ds = Subset(val_ds, range(rank, len(val_ds), world_size))
+    train_dl = DataLoader(train_ds, batch_size=train_bs,
+                          sampler=train_sampler, **loader_kwargs)
+    val_dl = DataLoader(val_ds, batch_size=val_bs, **loader_kwargs)
     return train_dl, val_dl
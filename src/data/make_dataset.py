@@ -3,49 +3,97 @@ import click
 import logging
 import coloredlogs
 import pandas as pd
-import unicodedata
-import string
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import List, Optional, Tuple
 from dotenv import find_dotenv, load_dotenv
-from nltk import stem
-from nltk.corpus import stopwords
+from src.data.clean_cache import CleanCache
+from src.data.stream import imap_bounded
+from src.features.build_features import TextCleaner
 
 
-def clean_text(txt: str,
-               stemmer: stem.api.StemmerI
-               ) -> str:
-    """Preprocesses the text to make it suitable for NLP
-    algorithms. Adapted for French comments.
+# Cleaner of the processes of the pool, see `main`
+_worker_cleaner: Optional[TextCleaner] = None
+
+
+def _init_worker(cleaner: TextCleaner) -> None:
+    global _worker_cleaner
+    _worker_cleaner = cleaner
+
+
+def clean_chunk(item: Tuple[pd.DataFrame, List[bytes], List[Optional[str]]],
+                cleaner: Optional[TextCleaner] = None
+                ) -> Tuple[pd.DataFrame, List[Tuple[bytes, str]]]:
+    """Cleans the comments of a chunk of the raw CSV that weren't
+    found in the cache and renames its columns to `x` and `y`.
 
     Args:
-        txt (str): original text
-        stemmer (stem.api.StemmerI): NLTK stemmer for stemming
+        item (Tuple[pd.DataFrame, List[bytes], List[Optional[str]]]):
+            chunk with a `comment` column, the cache keys of its
+            comments and their cleaned version (`None` if not cached)
+        cleaner (Optional[TextCleaner], optional): the cleaner.
+            Defaults to the cleaner of the pool process.
 
     Returns:
-        str: cleaned text
+        Tuple[pd.DataFrame, List[Tuple[bytes, str]]]: the cleaned chunk
+            and the (key, cleaned comment) pairs to add to the cache
     """
-    sw = set(stopwords.words('french'))
-    new_txt = ''.join([c.lower() if c not in string.punctuation else ' ' for c
-                       in txt])
-    new_txt = (unicodedata.normalize('NFKD', new_txt)
-               .encode('ascii', 'ignore')
-               .decode('utf-8', 'ignore'))
-    new_txt = " ".join([word for word in new_txt.split()
-                        if word and word not in sw])
-    new_txt = ' '.join([stemmer.stem(word) for word in new_txt.split()])
-    return new_txt
+    cleaner = cleaner or _worker_cleaner
+    chunk, keys, cleaned = item
+    missing = [i for i, txt in enumerate(cleaned) if txt is None]
+    for i, txt in zip(missing,
+                      cleaner.clean_batch(chunk.comment.iloc[missing])):
+        cleaned[i] = txt
+
+    chunk = chunk.copy()
+    chunk.comment = cleaned
+    chunk.columns = ['x', 'y']
+    new_entries = [(keys[i], cleaned[i]) for i in missing] if keys else []
+    return chunk, new_entries
+
+
+def lookup_chunk(chunk: pd.DataFrame, cache: Optional[CleanCache] = None
+                 ) -> Tuple[pd.DataFrame, List[bytes], List[Optional[str]]]:
+    """Fetches the cleaned comments of a chunk from the cache, see
+    `clean_chunk`"""
+    if cache is None:
+        return chunk, [], [None] * chunk.shape[0]
+    keys = cache.keys(chunk.comment)
+    return chunk, keys, cache.get_many(keys)
 
 
 @click.command()
 @click.argument('input_filepath', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
 @click.argument('csv_file', type=click.Path(exists=True))
+@click.option("--chunksize", "-cs", type=int, default=None,
+              help="Streams the CSV by chunks of this number of lines")
+@click.option("--workers", "-w", type=int, default=1,
+              help="Number of processes cleaning the chunks")
+@click.option("--cache/--no-cache", "use_cache", default=True,
+              help="Reuses the comments cleaned by the previous runs")
+@click.option("--cache-path", type=click.Path(), default=None,
+              help="Defaults to data/interim/clean_cache.sqlite")
 def main(input_filepath: str,
          output_filepath: str,
-         csv_file: str
+         csv_file: str,
+         chunksize: Optional[int] = None,
+         workers: int = 1,
+         use_cache: bool = True,
+         cache_path: Optional[str] = None
          ) -> None:
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
+
+        With `--chunksize`, the CSV is read, cleaned and written chunk
+        by chunk, so that only a few chunks are in memory at once.
+        With `--workers`, the chunks are cleaned by a pool of processes
+        and written in their original order.
+
+        The cleaned comments are cached in data/interim, so a new run
+        only cleans the comments that were added or changed since. The
+        cache is emptied when the stopwords or the stemmer change.
     """
     input_filepath = Path(input_filepath)
     output_filepath = Path(output_filepath)
@@ -55,20 +103,63 @@ def main(input_filepath: str,
     logger.info('making final data set from raw data')
     logger.info(f"N° of files: {len(list(input_filepath.iterdir()))}")
 
-    stemmer = stem.regexp.RegexpStemmer('s$|es$|era$|erez$|ions$| <etc> ')
-    logger.info(f"Using {stemmer.__class__.__name__} as stemmer.")
+    cleaner = TextCleaner()
+    logger.info(f"Using {cleaner}")
 
-    logger.info(f"Loading CSV from {csv_file}")
-    df = pd.read_csv(csv_file)
-
-    logger.info(f"{df.shape[0]} lines / {df.shape[1]} columns")
-
-    df.comment = df.comment.apply(lambda x: clean_text(x, stemmer=stemmer))
+    cache = None
+    if use_cache:
+        cache_path = cache_path or (input_filepath.parent / "interim"
+                                    / "clean_cache.sqlite")
+        cache = CleanCache(cache_path, cleaner.fingerprint)
+        if cache.invalidated:
+            logger.info("Cleaner changed, cache emptied")
+        logger.info(f"Using cache at {cache_path} ({len(cache)} entries)")
 
-    df.columns = ['x', 'y']
-
-    logger.info(f"Saving at {output_filepath / 'comments_clean.csv'}")
-    df.to_csv(output_filepath / "comments_clean.csv", index=None)
+    logger.info(f"Loading CSV from {csv_file}")
+    if chunksize:
+        logger.info(f"Streaming by chunks of {chunksize} lines "
+                    f"with {workers} worker(s)")
+        chunks = pd.read_csv(csv_file, chunksize=chunksize)
+    else:
+        chunks = [pd.read_csv(csv_file)]
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers,
+                                       initializer=_init_worker,
+                                       initargs=(cleaner,))
+        clean_fn = clean_chunk
+    else:
+        clean_fn = partial(clean_chunk, cleaner=cleaner)
+
+    csv_path = output_filepath / "comments_clean.csv"
+    tmp_path = csv_path.with_suffix(".csv.tmp")
+    n_lines = 0
+    try:
+        looked_up = (lookup_chunk(chunk, cache) for chunk in chunks)
+        cleaned = imap_bounded(clean_fn, looked_up,
+                               executor=executor, max_pending=2 * workers)
+        for i, (chunk, new_entries) in enumerate(cleaned):
+            if cache is not None:
+                cache.put_many(new_entries)
+            chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a',
+                         header=i == 0, index=None)
+            n_lines += chunk.shape[0]
+            if chunksize:
+                logger.info(f"{n_lines} lines cleaned")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            logger.info(f"Cache: {cache.hits} hits / {cache.misses} misses")
+            cache.close()
+
+    if n_lines == 0:
+        # A CSV without comments is read as no chunk at all
+        pd.DataFrame(columns=['x', 'y']).to_csv(tmp_path, index=None)
+    logger.info(f"{n_lines} lines / 2 columns")
+    logger.info(f"Saving at {csv_path}")
+    tmp_path.replace(csv_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def imap_bounded(fn: Callable[[T], R],
+                 items: Iterable[T],
+                 executor: Optional[Executor] = None,
+                 max_pending: int = 4) -> Iterator[R]:
+    """Lazily maps a function over an iterable, in order.
+
+    Unlike `Executor.map`, which consumes the whole iterable at once,
+    at most `max_pending` items are submitted ahead of the result
+    being yielded, so a stream of chunks is never fully held in
+    memory. Without executor, the function runs in the current
+    process.
+
+    Args:
+        fn (Callable[[T], R]): the function to map
+        items (Iterable[T]): the items (ex. chunks of a CSV)
+        executor (Optional[Executor], optional): the pool running the
+            function. Defaults to None.
+        max_pending (int, optional): maximum number of items submitted
+            and not yielded yet. Defaults to 4.
+
+    Yields:
+        Iterator[R]: the results, in the order of the items
+    """
+    if executor is None:
+        yield from map(fn, items)
+        return
+
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
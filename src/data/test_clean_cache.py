@@ -0,0 +1,31 @@
+import hashlib
+from .clean_cache import CleanCache
+
+texts = ["Super resto !", "Service lent", "Plat froid"]
+
+
+def fingerprint(cleaner: str) -> str:
+    return hashlib.sha256(cleaner.encode("utf-8")).hexdigest()
+
+
+def test_clean_cache(tmp_path):
+    path = tmp_path / "clean_cache.sqlite"
+    cache = CleanCache(path, fingerprint("stemmer 1"))
+    keys = cache.keys(texts)
+    cache.put_many(zip(keys[:2], ["sup resto", "servic lent"]))
+    assert cache.get_many(keys) == ["sup resto", "servic lent", None]
+    assert (cache.hits, cache.misses) == (2, 1)
+    cache.close()
+
+    # Reopened with the same cleaner, the entries are kept
+    cache = CleanCache(path, fingerprint("stemmer 1"))
+    assert not cache.invalidated and len(cache) == 2
+    assert cache.get_many(keys[:1]) == ["sup resto"]
+    cache.close()
+
+    # With another cleaner, they are dropped
+    cache = CleanCache(path, fingerprint("stemmer 2"))
+    assert cache.invalidated and len(cache) == 0
+    assert cache.get_many(cache.keys(texts)) == [None] * 3
+    assert (cache.hits, cache.misses) == (0, 3)
+    cache.close()
@@ -0,0 +1,123 @@
+import click
+import json
+import logging
+import time
+import coloredlogs
+import numpy as np
+import pandas as pd
+import torch
+from joblib import load
+from pathlib import Path
+from typing import Dict, List
+from sklearn.pipeline import Pipeline
+from src.models.nn_model import SimpleNN, export_torchscript
+from src.models.nn_serving import TorchClassifier
+from src.models.serving import check_parity, dump_model, with_cleaner
+
+
+def nn_pipeline(model: SimpleNN, vectorizer, quantize: bool) -> Pipeline:
+    """Pipeline of the fitted vectorizer and of the exported network"""
+    module = export_torchscript(model, quantize=quantize)
+    return Pipeline([("vectorizer", vectorizer),
+                     ("nn", TorchClassifier(module))])
+
+
+def measure(pipeline: Pipeline, texts: List[str],
+            n_single: int = 200) -> Dict[str, float]:
+    """Measures the size of the network of a pipeline, its latency on
+    single comments and its throughput on the whole batch
+
+    Returns:
+        Dict[str, float]: the size (MiB), the median and p95 latency
+            of a single comment (ms) and the comments per second
+    """
+    latencies = []
+    for text in texts[:n_single]:
+        start = time.perf_counter()
+        pipeline.predict([text])
+        latencies.append(1000 * (time.perf_counter() - start))
+    start = time.perf_counter()
+    pipeline.predict(texts)
+    elapsed = time.perf_counter() - start
+    return {"size_mib": pipeline[-1].archive_size() / 2 ** 20,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "texts_per_s": len(texts) / elapsed}
+
+
+@click.command()
+@click.argument('model_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('output_path', type=click.Path())
+@click.argument('csv_path', type=click.Path(exists=True))
+@click.option("--quantize/--no-quantize", default=True,
+              help="Quantizes the linear layers to int8")
+@click.option("--min-agreement", "-ma", type=float, default=0.98,
+              help=("Minimum proportion of predictions identical to "
+                    "those of the fp32 network"))
+@click.option("--add-cleaner/--no-add-cleaner", default=True,
+              help=("Prepends the cleaner, so that the model predicts "
+                    "raw comments"))
+@click.option("--threads", "-t", "n_threads", type=int, default=1,
+              help="Number of torch threads of the measures")
+def main(model_dir: str,
+         output_path: str,
+         csv_path: str,
+         quantize: bool = True,
+         min_agreement: float = 0.98,
+         add_cleaner: bool = True,
+         n_threads: int = 1
+         ) -> None:
+    """ Exports the network trained by `train_nn_model` in MODEL_DIR
+        for CPU serving: the network, made dense, int8-quantized and
+        traced to TorchScript, is saved with the cleaner and its
+        fitted vectorizer as a joblib pipeline (ex.
+        models/nn_pipe.joblib, served by the API as `nn_pipe`), which
+        predicts raw comments like the pipelines of `train_ml_model`
+        (unless --no-add-cleaner).
+
+        The exported network is compared to the fp32 one on the
+        cleaned comments of CSV_PATH (size, latency, throughput and
+        agreement), and only saved if they predict alike.
+    """
+    logger = logging.getLogger('export-model')
+    torch.set_num_threads(n_threads)
+    model_dir = Path(model_dir)
+
+    logger.info(f"Loading the network of {model_dir}")
+    with open(model_dir / "nn_config.json") as f:
+        model = SimpleNN(**json.load(f))
+    model.load_state_dict(torch.load(model_dir / "nn_model.pt",
+                                     map_location="cpu"))
+    vectorizer = load(model_dir / "nn_vectorizer.joblib")
+    texts = pd.read_csv(csv_path).x.fillna('').astype(str).tolist()
+
+    reference = nn_pipeline(model, vectorizer, quantize=False)
+    serving_model = nn_pipeline(model, vectorizer, quantize=quantize)
+
+    agreement = check_parity(reference, serving_model, texts)
+    logger.info(f"Identical predictions: {agreement:.2%}")
+    if agreement < min_agreement:
+        raise click.ClickException(f"Agreement below {min_agreement:.2%}, "
+                                   "serving model not saved")
+
+    names = ["fp32", "int8"] if quantize else ["fp32"]
+    for name, pipeline in zip(names, [reference, serving_model]):
+        stats = measure(pipeline, texts)
+        logger.info(f"{name}: {stats['size_mib']:.1f} MiB, "
+                    f"p50 {stats['p50_ms']:.2f} ms, "
+                    f"p95 {stats['p95_ms']:.2f} ms per comment, "
+                    f"{stats['texts_per_s']:.0f} comments/s in batch")
+
+    if add_cleaner:
+        logger.info("Prepending the cleaner to the serving model")
+        serving_model = with_cleaner(serving_model)
+    dump_model(serving_model, output_path)
+    logger.info(f"Serving model saved at {output_path}")
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    coloredlogs.install()
+
+    main()
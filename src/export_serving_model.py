@@ -0,0 +1,122 @@
+import click
+import logging
+import time
+import coloredlogs
+import pandas as pd
+from joblib import load
+from sklearn.pipeline import Pipeline
+from sklearn.svm import LinearSVC
+from src.models.serving import (check_parity, dump_model, has_cleaner,
+                                is_linear, linearize, save_compact,
+                                with_cleaner)
+
+
+def distill(model: Pipeline, texts: pd.Series) -> Pipeline:
+    """Fits a linear SVC on the predictions of a pipeline whose
+    classifier isn't linear (ex. SVC with a RBF kernel), reusing its
+    preprocessing steps
+
+    Args:
+        model (Pipeline): the fitted pipeline
+        texts (pd.Series): cleaned texts
+
+    Returns:
+        Pipeline: the pipeline with a linear classifier
+    """
+    features = model[:-1].transform(texts)
+    clf = LinearSVC().fit(features, model.predict(texts))
+    return Pipeline(model.steps[:-1] + [("linearsvc", clf)])
+
+
+@click.command()
+@click.argument('model_path', type=click.Path(exists=True))
+@click.argument('output_path', type=click.Path())
+@click.argument('csv_path', type=click.Path(exists=True))
+@click.option("--distill/--no-distill", "allow_distill", default=False,
+              help=("Trains a linear SVC on the predictions of the model "
+                    "when its classifier isn't linear"))
+@click.option("--min-agreement", "-ma", type=float, default=None,
+              help=("Minimum proportion of identical predictions "
+                    "(1.0 by default, 0.98 when distilled)"))
+@click.option("--add-cleaner/--no-add-cleaner", default=False,
+              help=("Prepends the cleaner to a model trained on cleaned "
+                    "comments, so that it predicts raw comments"))
+@click.option("--format", "-f", "artifact_format",
+              type=click.Choice(["joblib", "compact"]), default="joblib",
+              help=("compact saves a directory of memory-mappable arrays "
+                    "(ex. models/svm_pipe.compact)"))
+def main(model_path: str,
+         output_path: str,
+         csv_path: str,
+         allow_distill: bool = False,
+         min_agreement: float = None,
+         add_cleaner: bool = False,
+         artifact_format: str = "joblib"
+         ) -> None:
+    """ Exports a TF-IDF + linear classifier pipeline for serving: the
+        classifier is replaced by its weight vector over the vocabulary,
+        so that a prediction is one sparse dot product. The serving
+        model is only saved if it predicts the cleaned comments of
+        CSV_PATH like the original model.
+
+        With `--format compact`, the vocabulary, IDF and weights are
+        saved as flat numpy arrays that the API memory-maps instead of
+        unpickling a vocabulary dict.
+    """
+    logger = logging.getLogger('export-model')
+
+    logger.info(f"Loading {model_path}")
+    model = load(model_path)
+    cleaner = None
+    if has_cleaner(model):
+        # The comments of the CSV are already cleaned
+        cleaner, model = model.steps[0][1], model[1:]
+    clf = model.steps[-1][1]
+    texts = pd.read_csv(csv_path).x.fillna('')
+
+    linear_model = model
+    if is_linear(clf):
+        logger.info(f"{type(clf).__name__} is linear, extracting weights")
+        if min_agreement is None:
+            min_agreement = 1.0
+    elif allow_distill:
+        logger.info(f"{type(clf).__name__} isn't linear, distilling it "
+                    f"on {texts.size} comments")
+        linear_model = distill(model, texts)
+        if min_agreement is None:
+            min_agreement = 0.98
+    else:
+        raise click.ClickException(f"{clf!r} isn't linear, use --distill "
+                                   "to train a linear equivalent")
+
+    serving_model = linearize(linear_model)
+
+    agreement = check_parity(model, serving_model, texts)
+    logger.info(f"Identical predictions: {agreement:.2%}")
+    if agreement < min_agreement:
+        raise click.ClickException(f"Agreement below {min_agreement:.2%}, "
+                                   "serving model not saved")
+
+    for name, m in [("Original", model), ("Serving", serving_model)]:
+        start = time.perf_counter()
+        m.predict(texts)
+        logger.info(f"{name} model: {time.perf_counter() - start:.3f}s "
+                    f"for {texts.size} comments")
+
+    if cleaner is not None or add_cleaner:
+        logger.info("Prepending the cleaner to the serving model")
+        serving_model = with_cleaner(serving_model, cleaner)
+
+    if artifact_format == "compact":
+        save_compact(serving_model, output_path)
+    else:
+        dump_model(serving_model, output_path)
+    logger.info(f"Serving model saved at {output_path}")
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    coloredlogs.install()
+
+    main()
@@ -0,0 +1,235 @@
+import hashlib
+import re
+import string
+import unicodedata
+import numpy as np
+import scipy.sparse as sp
+from typing import Iterable, List, Optional
+from nltk.corpus import stopwords as nltk_stopwords
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+STEMMER_PATTERN = 's$|es$|era$|erez$|ions$| <etc> '
+
+
+class _StemCache(dict):
+    """Maps a word to its stem, or to `None` for a stopword,
+    computing each word once"""
+    def __init__(self, stem_re: re.Pattern, stopwords: frozenset):
+        super().__init__()
+        self.stem_re = stem_re
+        self.stopwords = stopwords
+
+    def __missing__(self, word: str) -> Optional[str]:
+        stem = None if word in self.stopwords else self.stem_re.sub('', word)
+        self[word] = stem
+        return stem
+
+
+class TextCleaner:
+    """Preprocesses texts to make them suitable for NLP
+    algorithms. Adapted for French comments.
+
+    The text is lowercased with its punctuation replaced by spaces,
+    its accents stripped (NFKD normalization, ASCII only), then its
+    stopwords are removed and its words stemmed by a regular
+    expression (like `nltk.stem.RegexpStemmer`).
+
+    Everything that doesn't depend on the text (stopword set,
+    punctuation and stemmer regular expressions) is compiled once,
+    and the stem of each distinct word is computed once.
+    `clean_batch` runs the character-level steps on a whole batch
+    at once.
+
+    Args:
+        stopwords (Optional[Iterable[str]], optional): the words to
+            remove. Defaults to the French stopwords of NLTK.
+        stemmer_pattern (str, optional): the suffixes to remove.
+            Defaults to STEMMER_PATTERN.
+    """
+    # To bump whenever the cleaning steps change
+    VERSION = "1"
+
+    def __init__(self,
+                 stopwords: Optional[Iterable[str]] = None,
+                 stemmer_pattern: str = STEMMER_PATTERN):
+        if stopwords is None:
+            stopwords = nltk_stopwords.words('french')
+        self.stopwords = frozenset(stopwords)
+        self.stemmer_pattern = stemmer_pattern
+        self._punct_re = re.compile(f"[{re.escape(string.punctuation)}]")
+        self._stems = _StemCache(re.compile(stemmer_pattern),
+                                 self.stopwords)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_stems"] = _StemCache(self._stems.stem_re, self.stopwords)
+        return state
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the configuration of the cleaner: two cleaners
+        with the same fingerprint clean texts the same way.
+
+        Returns:
+            str: hexadecimal digest
+        """
+        config = '\n'.join([self.VERSION, self.stemmer_pattern]
+                           + sorted(self.stopwords))
+        return hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+    def __repr__(self):
+        return (f"TextCleaner({len(self.stopwords)} stopwords, "
+                f"stemmer={self.stemmer_pattern!r})")
+
+    def clean(self, txt: str) -> str:
+        """Cleans a single text
+
+        Args:
+            txt (str): original text
+
+        Returns:
+            str: cleaned text
+        """
+        return self.clean_batch([txt])[0]
+
+    def clean_batch(self, texts: Iterable[str]) -> List[str]:
+        """Cleans a batch of texts (list, pandas Series...)
+
+        Args:
+            texts (Iterable[str]): original texts
+
+        Returns:
+            List[str]: cleaned texts, in the same order
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+
+        # The texts are cleaned as one string, separated by newlines
+        batch = '\n'.join([txt.replace('\n', ' ') for txt in texts])
+        batch = self._punct_re.sub(' ', batch).lower()
+        batch = (unicodedata.normalize('NFKD', batch)
+                 .encode('ascii', 'ignore')
+                 .decode('utf-8', 'ignore'))
+
+        stems = self._stems
+        return [' '.join([stem for stem in map(stems.__getitem__,
+                                               txt.split())
+                          if stem is not None])
+                for txt in batch.split('\n')]
+
+
+class CleanerTransformer(BaseEstimator, TransformerMixin):
+    """Scikit-learn step cleaning raw texts with a `TextCleaner`, so
+    that a pipeline starting with it predicts raw comments, cleaned
+    the same way as the training data.
+
+    Fitting resolves the stopwords (the NLTK ones by default), which
+    are then saved with the pipeline: loading it doesn't need the
+    NLTK corpus.
+
+    Args:
+        stopwords (Optional[List[str]], optional): the words to
+            remove. Defaults to the French stopwords of NLTK.
+        stemmer_pattern (str, optional): the suffixes to remove.
+            Defaults to STEMMER_PATTERN.
+    """
+    def __init__(self,
+                 stopwords: Optional[List[str]] = None,
+                 stemmer_pattern: str = STEMMER_PATTERN):
+        self.stopwords = stopwords
+        self.stemmer_pattern = stemmer_pattern
+
+    def fit(self, X=None, y=None):
+        self.cleaner_ = TextCleaner(self.stopwords, self.stemmer_pattern)
+        return self
+
+    def transform(self, X: Iterable[str]) -> List[str]:
+        return self.cleaner_.clean_batch(X)
+
+
+class HashingTfidf(BaseEstimator, TransformerMixin):
+    """TF-IDF features of a fixed dimension, the words being hashed
+    into `n_features` columns instead of looked up in a vocabulary.
+
+    The memory used doesn't grow with the corpus, and the document
+    frequencies are counted by `partial_fit`, batch by batch, so the
+    IDF weights can be computed from a stream of comments and updated
+    with new ones. The IDF and normalization are the ones of
+    `TfidfVectorizer` (smoothed IDF, l2 norm by default); the words
+    whose hashes collide share a column.
+
+    Args:
+        n_features (int, optional): number of columns.
+            Defaults to 2**18.
+        norm (Optional[str], optional): norm of the rows.
+            Defaults to "l2".
+        sublinear_tf (bool, optional): whether the term frequencies
+            are replaced by 1 + log(tf). Defaults to False.
+        dtype (type, optional): type of the features.
+            Defaults to np.float64.
+    """
+    def __init__(self,
+                 n_features: int = 2 ** 18,
+                 norm: Optional[str] = "l2",
+                 sublinear_tf: bool = False,
+                 dtype: type = np.float64):
+        self.n_features = n_features
+        self.norm = norm
+        self.sublinear_tf = sublinear_tf
+        self.dtype = dtype
+
+    def _counts(self, X: Iterable[str]) -> sp.csr_matrix:
+        hasher = HashingVectorizer(n_features=self.n_features,
+                                   alternate_sign=False, norm=None,
+                                   dtype=self.dtype)
+        return hasher.transform(X)
+
+    def fit(self, X: Iterable[str], y=None):
+        for attr in ("n_docs_", "df_"):
+            self.__dict__.pop(attr, None)
+        return self.partial_fit(X)
+
+    def partial_fit(self, X: Iterable[str], y=None):
+        """Counts the documents of a batch in which each column
+        appears"""
+        counts = self._counts(X)
+        if not hasattr(self, "df_"):
+            self.n_docs_ = 0
+            self.df_ = np.zeros(self.n_features, dtype=np.int64)
+        self.n_docs_ += counts.shape[0]
+        self.df_ += np.bincount(counts.indices, minlength=self.n_features)
+        return self
+
+    @property
+    def idf_(self) -> np.ndarray:
+        return (np.log((1 + self.n_docs_) / (1 + self.df_)) + 1).astype(
+            self.dtype)
+
+    def transform(self, X: Iterable[str]) -> sp.csr_matrix:
+        Xt = self._counts(X)
+        if self.sublinear_tf:
+            np.log(Xt.data, Xt.data)
+            Xt.data += 1
+        Xt.data *= self.idf_[Xt.indices]
+        if self.norm:
+            Xt = normalize(Xt, norm=self.norm, copy=False)
+        return Xt
+
+
+_default_cleaner: Optional[TextCleaner] = None
+
+
+def get_cleaner() -> TextCleaner:
+    """Returns the cleaner shared by the project, built on first use
+
+    Returns:
+        TextCleaner: cleaner with the French stopwords and the
+            default stemmer
+    """
+    global _default_cleaner
+    if _default_cleaner is None:
+        _default_cleaner = TextCleaner()
+    return _default_cleaner
@@ -0,0 +1,35 @@
+import pickle
+
+from .build_features import CleanerTransformer, HashingTfidf, TextCleaner
+
+cleaner = TextCleaner(stopwords=["a", "de", "est", "le", "un"])
+
+
+def test_clean():
+    assert cleaner.clean("C'est un SUPER resto!") == "c super resto"
+    assert cleaner.clean("Le café de l'hôtel") == "cafe l hotel"
+    assert (cleaner.clean("Plats délicieux et desserts")
+            == "plat delicieux et dessert")
+
+
+def test_clean_batch():
+    texts = ["Très bon !", "", "Service\nlent...", "Le café de l'hôtel"]
+    assert cleaner.clean_batch(texts) == [cleaner.clean(txt) for txt in texts]
+    assert cleaner.clean_batch([]) == []
+
+
+def test_cleaner_transformer():
+    texts = ["C'est un SUPER resto!", "Le café de l'hôtel"]
+    step = CleanerTransformer(stopwords=["a", "de", "est", "le", "un"])
+    step = pickle.loads(pickle.dumps(step.fit()))
+    assert step.transform(texts) == cleaner.clean_batch(texts)
+
+
+def test_hashing_tfidf_partial_fit():
+    texts = ["super resto", "service lent", "super service", "plat froid"]
+    full = HashingTfidf(n_features=2 ** 10).fit(texts)
+    streamed = HashingTfidf(n_features=2 ** 10)
+    for start in range(0, len(texts), 2):
+        streamed.partial_fit(texts[start:start + 2])
+    assert streamed.transform(texts).shape == (4, 2 ** 10)
+    assert (full.transform(texts) != streamed.transform(texts)).nnz == 0
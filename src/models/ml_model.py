@@ -1,19 +1,186 @@
+import os
 import numpy as np
-from typing import Dict, Any, Tuple
-from sklearn.base import BaseEstimator
+from joblib import dump, hash as joblib_hash, load
+from pathlib import Path
+from typing import Dict, Any, Callable, Optional, Tuple, Union
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.svm import SVC
-from sklearn.pipeline import make_pipeline
-from sklearn.model_selection import GridSearchCV
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import (GridSearchCV, HalvingGridSearchCV,
+                                     RandomizedSearchCV)
 from sklearn.naive_bayes import MultinomialNB
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from src.features.build_features import HashingTfidf
+
+
+class FeatureCache:
+    """Disk cache of text features, shared by every fold, candidate
+    and model of a hyperparameter search.
+
+    The features of a training fold are stored under a hash of the
+    vectorizer parameters and of the fold's texts, the features of a
+    test fold under the key of the fit and a hash of its texts. Since
+    the cache lives on disk, it is shared with the processes of a
+    parallel search, and the hits and misses are counted in files
+    (one byte per event) to be summed over all of them.
+
+    Args:
+        cache_dir (Union[str, Path]): directory of the cache
+    """
+    def __init__(self, cache_dir: Union[str, Path]):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _count(self, event: str) -> None:
+        with open(self.cache_dir / f"{event}.count", "ab") as f:
+            f.write(b".")
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        """Returns the value stored under a key, computing and
+        storing it if it isn't in the cache yet."""
+        path = self.cache_dir / f"{key}.joblib"
+        if path.exists():
+            self._count("hits")
+            return load(path)
+
+        self._count("misses")
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def get(self, key: str) -> Any:
+        return load(self.cache_dir / f"{key}.joblib")
+
+    def put(self, key: str, value: Any) -> None:
+        path = self.cache_dir / f"{key}.joblib"
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        dump(value, tmp_path)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of hits and misses since the creation
+        of the cache directory"""
+        counts = {}
+        for event in ("hits", "misses"):
+            path = self.cache_dir / f"{event}.count"
+            counts[event] = path.stat().st_size if path.exists() else 0
+        return counts
+
+
+class CachedVectorizer(BaseEstimator, TransformerMixin):
+    """Vectorizer step whose features are read from a `FeatureCache`
+    when the same texts were already vectorized with the same
+    parameters, instead of being computed again.
+
+    Use `strip_feature_cache` on a fitted pipeline to get back the
+    plain vectorizer before saving it.
+
+    Args:
+        vectorizer (BaseEstimator, optional): the vectorizer.
+            Defaults to a `TfidfVectorizer`.
+        cache (Optional[FeatureCache], optional): the cache. Without
+            cache, the features are always computed. Defaults to None.
+    """
+    def __init__(self,
+                 vectorizer: Optional[BaseEstimator] = None,
+                 cache: Optional[FeatureCache] = None):
+        self.vectorizer = vectorizer
+        self.cache = cache
+
+    def _fit(self, X):
+        self.vectorizer_ = clone(self.vectorizer or TfidfVectorizer())
+        return self.vectorizer_.fit_transform(X)
+
+    def fit(self, X, y=None):
+        self.fit_transform(X, y)
+        return self
+
+    def fit_transform(self, X, y=None):
+        if self.cache is None:
+            return self._fit(X)
+
+        # The fitted vectorizer is only loaded when it is needed,
+        # see `fitted_vectorizer`
+        self.fit_key_ = joblib_hash((self.vectorizer, X))
+        self.vectorizer_ = None
+
+        def fit():
+            Xt = self._fit(X)
+            self.cache.put(f"vectorizer-{self.fit_key_}", self.vectorizer_)
+            return Xt
+
+        return self.cache.get_or_compute(f"fit-{self.fit_key_}", fit)
+
+    def fitted_vectorizer(self) -> BaseEstimator:
+        if self.vectorizer_ is None:
+            self.vectorizer_ = self.cache.get(f"vectorizer-{self.fit_key_}")
+        return self.vectorizer_
+
+    def transform(self, X):
+        if self.cache is None:
+            return self.vectorizer_.transform(X)
+
+        key = joblib_hash((self.fit_key_, X))
+        return self.cache.get_or_compute(
+            f"transform-{key}", lambda: self.fitted_vectorizer().transform(X))
+
+
+def strip_feature_cache(model: BaseEstimator) -> BaseEstimator:
+    """Replaces the `CachedVectorizer` steps of a fitted pipeline by
+    the vectorizers they fitted, named as `make_pipeline` names them.
+
+    Args:
+        model (BaseEstimator): a fitted pipeline
+
+    Returns:
+        BaseEstimator: the same pipeline, without reference to the cache
+    """
+    if isinstance(model, Pipeline):
+        steps = []
+        for name, step in model.steps:
+            if isinstance(step, CachedVectorizer):
+                step = step.fitted_vectorizer()
+                name = type(step).__name__.lower()
+            steps.append((name, step))
+        model.steps = steps
+    return model
+
+
+def make_vectorizer(kind: str = "tfidf",
+                    n_features: int = 2 ** 18) -> BaseEstimator:
+    """Builds the vectorizer of the text models
+
+    Args:
+        kind (str, optional): `tfidf` for a `TfidfVectorizer`, whose
+            vocabulary grows with the corpus, or `hashing` for a
+            `HashingTfidf` of `n_features` columns. Defaults to "tfidf".
+        n_features (int, optional): number of columns of the hashing
+            vectorizer. Defaults to 2**18.
+
+    Returns:
+        BaseEstimator: the vectorizer
+    """
+    if kind == "tfidf":
+        return TfidfVectorizer()
+    if kind == "hashing":
+        return HashingTfidf(n_features=n_features)
+    raise ValueError(f"Unknown vectorizer: {kind}")
 
 
 def generate_best_model(model_name: str,
                         X: np.ndarray,
-                        y: np.ndarray) -> BaseEstimator:
-    """Fetches a model from the model list and runs a grid search
-    CV on it. Returns the best model with the best score.
+                        y: np.ndarray,
+                        cache: Optional[FeatureCache] = None,
+                        search: str = "grid",
+                        n_jobs: Optional[int] = None,
+                        random_state: Optional[int] = None,
+                        vectorizer: str = "tfidf",
+                        n_features: int = 2 ** 18
+                        ) -> BaseEstimator:
+    """Fetches a model from the model list and runs a hyperparameter
+    search CV on it. Returns the best model with the best score.
 
     Models available:
     * SVM: `svm`
@@ -24,44 +191,113 @@ def generate_best_model(model_name: str,
         model_name (str): name of the model
         X (np.ndarray): The data with features
         y (np.ndarray): The labels
+        cache (Optional[FeatureCache], optional): cache of the TF-IDF
+            features of the folds. Defaults to None.
+        search (str, optional): search strategy, see
+            `BestModel.fit_best_model`. Defaults to "grid".
+        n_jobs (Optional[int], optional): number of candidates fitted
+            in parallel (-1 for all cores). Defaults to None.
+        random_state (Optional[int], optional): seed of the halving
+            and random searches. Defaults to None.
+        vectorizer (str, optional): kind of vectorizer, see
+            `make_vectorizer`. Defaults to "tfidf".
+        n_features (int, optional): number of columns of the hashing
+            vectorizer. Defaults to 2**18.
 
     Returns:
         BaseEstimator: Best version of the model
     """
+    vectorizer = make_vectorizer(vectorizer, n_features)
     model_list = {
-        "svm": BestSVM(),
-        "naive_bayes": BestNaiveBayes(),
-        'lr': BestLogisticRegression()
+        "svm": BestSVM(cache, vectorizer),
+        "naive_bayes": BestNaiveBayes(cache, vectorizer),
+        'lr': BestLogisticRegression(cache, vectorizer)
     }
 
     model = model_list[model_name]
-    return model.fit_best_model(X, y)
+    return model.fit_best_model(X, y, search=search, n_jobs=n_jobs,
+                                random_state=random_state)
 
 
 class BestModel:
     """Base class for text models
+
+    Args:
+        cache (Optional[FeatureCache], optional): cache of the TF-IDF
+            features of the folds. Defaults to None.
+        vectorizer (Optional[BaseEstimator], optional): the vectorizer,
+            see `make_vectorizer`. Defaults to a `TfidfVectorizer`.
     """
-    def __init__(self):
+    def __init__(self,
+                 cache: Optional[FeatureCache] = None,
+                 vectorizer: Optional[BaseEstimator] = None):
         self.model: BaseEstimator = None
         self.name: str = ""
         self.params: Dict[str, Any] = {}
+        self.cache = cache
+        self._vectorizer = vectorizer or TfidfVectorizer()
+
+    def vectorizer(self) -> CachedVectorizer:
+        return CachedVectorizer(clone(self._vectorizer), cache=self.cache)
 
     def fit_best_model(self,
                        X: np.ndarray,
-                       y: np.ndarray) -> Tuple[BaseEstimator, float]:
-        gs_cv = GridSearchCV(self.model, self.params, cv=5)
+                       y: np.ndarray,
+                       search: str = "grid",
+                       n_jobs: Optional[int] = None,
+                       random_state: Optional[int] = None,
+                       n_iter: int = 20) -> Tuple[BaseEstimator, float]:
+        """Searches the best hyperparameters of the model, with:
+
+        * `grid`: every combination of the grid
+        * `halving`: successive halving, fitting every combination on
+          a few samples and only keeping the best ones as the number
+          of samples grows
+        * `random`: `n_iter` combinations drawn from the grid
+
+        Args:
+            X (np.ndarray): The data with features
+            y (np.ndarray): The labels
+            search (str, optional): search strategy. Defaults to "grid".
+            n_jobs (Optional[int], optional): number of candidates
+                fitted in parallel, by the current joblib backend
+                (threads inside a joblib worker, unless the loky
+                backend is asked for). Defaults to None.
+            random_state (Optional[int], optional): seed of the halving
+                and random searches. Defaults to None.
+            n_iter (int, optional): number of combinations of the
+                random search. Defaults to 20.
+
+        Returns:
+            Tuple[BaseEstimator, float]: the best model and its score
+        """
+        if search == "grid":
+            gs_cv = GridSearchCV(self.model, self.params, cv=5,
+                                 n_jobs=n_jobs)
+        elif search == "halving":
+            gs_cv = HalvingGridSearchCV(self.model, self.params, cv=5,
+                                        n_jobs=n_jobs,
+                                        random_state=random_state)
+        elif search == "random":
+            gs_cv = RandomizedSearchCV(self.model, self.params, cv=5,
+                                       n_iter=n_iter, n_jobs=n_jobs,
+                                       random_state=random_state)
+        else:
+            raise ValueError(f"Unknown search strategy: {search}")
         gs_cv.fit(X, y)
 
-        return gs_cv.best_estimator_, gs_cv.best_score_
+        return strip_feature_cache(gs_cv.best_estimator_), gs_cv.best_score_
 
     def __str__(self):
         return f"{self.name}\nN° of params: {len(self.params.keys())}"
 
 
 class BestSVM(BestModel):
-    def __init__(self):
-        super().__init__()
-        self.model = make_pipeline(TfidfVectorizer(), SVC())
+    def __init__(self,
+                 cache: Optional[FeatureCache] = None,
+                 vectorizer: Optional[BaseEstimator] = None):
+        super().__init__(cache, vectorizer)
+        self.model = make_pipeline(self.vectorizer(), SVC())
         self.name = SVC().__class__.__name__
         self.params = {"svc__C": np.logspace(0, 5, 10),
                        'svc__gamma': np.logspace(-6, 0, 10),
@@ -69,17 +305,77 @@ class BestSVM(BestModel):
 
 
 class BestNaiveBayes(BestModel):
-    def __init__(self):
-        super().__init__()
-        self.model = make_pipeline(TfidfVectorizer(), MultinomialNB())
+    def __init__(self,
+                 cache: Optional[FeatureCache] = None,
+                 vectorizer: Optional[BaseEstimator] = None):
+        super().__init__(cache, vectorizer)
+        self.model = make_pipeline(self.vectorizer(), MultinomialNB())
         self.name = MultinomialNB().__class__.__name__
         self.params = {"multinomialnb__alpha": np.linspace(0, 1, 20)}
 
 
 class BestLogisticRegression(BestModel):
-    def __init__(self):
-        super().__init__()
-        self.model = make_pipeline(TfidfVectorizer(), LogisticRegression())
+    def __init__(self,
+                 cache: Optional[FeatureCache] = None,
+                 vectorizer: Optional[BaseEstimator] = None):
+        super().__init__(cache, vectorizer)
+        self.model = make_pipeline(self.vectorizer(), LogisticRegression())
         self.name = MultinomialNB().__class__.__name__
         self.params = {"logisticregression__C": np.logspace(-4, 5, 20),
                        "logisticregression__penalty": ["l1", "l2"]}
+
+
+# Classifiers which can be trained batch by batch, see `partial_fit_model`
+STREAMING_CLASSIFIERS = {
+    "sgd": lambda: SGDClassifier(loss="hinge", alpha=1e-5),
+    "naive_bayes": lambda: MultinomialNB(alpha=0.1)
+}
+
+
+def make_streaming_model(classifier: str = "sgd",
+                         n_features: int = 2 ** 18) -> Pipeline:
+    """Builds a hashing TF-IDF pipeline trainable out-of-core
+
+    Args:
+        classifier (str, optional): `sgd` (linear SVM trained by
+            stochastic gradient descent) or `naive_bayes`.
+            Defaults to "sgd".
+        n_features (int, optional): number of columns of the hashing
+            vectorizer. Defaults to 2**18.
+
+    Returns:
+        Pipeline: the unfitted pipeline
+    """
+    return make_pipeline(HashingTfidf(n_features=n_features),
+                         STREAMING_CLASSIFIERS[classifier]())
+
+
+def partial_fit_model(model: Pipeline,
+                      X: np.ndarray,
+                      y: np.ndarray,
+                      classes: np.ndarray,
+                      update_idf: bool = True) -> Pipeline:
+    """Updates a hashing TF-IDF pipeline with a batch of comments:
+    the document frequencies of the vectorizer are updated with the
+    batch, then the classifier is trained on its features.
+
+    Args:
+        model (Pipeline): pipeline ending with a `HashingTfidf` and a
+            classifier with `partial_fit`, see `make_streaming_model`
+        X (np.ndarray): the cleaned comments of the batch
+        y (np.ndarray): their labels
+        classes (np.ndarray): every label of the stream
+        update_idf (bool, optional): whether the IDF weights are
+            updated with the batch. The first batch always fits them.
+            Defaults to True.
+
+    Returns:
+        Pipeline: the updated pipeline
+    """
+    vectorizer, clf = model.steps[-2][1], model.steps[-1][1]
+    if not isinstance(vectorizer, HashingTfidf):
+        raise ValueError("Only hashing pipelines can be trained by batch")
+    if update_idf or not hasattr(vectorizer, "df_"):
+        vectorizer.partial_fit(X)
+    clf.partial_fit(vectorizer.transform(X), y, classes=classes)
+    return model
@@ -1,10 +1,14 @@
 import logging
+import os
 import coloredlogs
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
-from sklearn.metrics import confusion_matrix, classification_report
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence, Tuple
+from sklearn.metrics import classification_report
 from tqdm import tqdm, trange
 
 
@@ -15,53 +19,159 @@ logger = logging.getLogger('nn-training')
 
 
 class SimpleNN(nn.Module):
-    def __init__(self, in_values, out_values):
+    """Fully connected network taking TF-IDF features.
+
+    The input layer either multiplies the features as a matrix
+    (`input_mode="dense"`, accepting dense or sparse CSR batches) or
+    is an `nn.EmbeddingBag` summing the embeddings of the words of
+    each comment weighted by their TF-IDF (`input_mode="bag"`), whose
+    cost only depends on the number of words of the comments. The
+    bag mode reads the words from CSR tensors, which need torch 2.0.
+
+    Args:
+        in_values (int): number of features
+        out_values (int): number of classes
+        hidden_sizes (Sequence[int], optional): sizes of the hidden
+            layers. Defaults to (12673, 4000, 500).
+        input_mode (str, optional): `dense` or `bag`.
+            Defaults to "dense".
+    """
+    def __init__(self, in_values: int, out_values: int,
+                 hidden_sizes: Sequence[int] = (12673, 4000, 500),
+                 input_mode: str = "dense"):
         super().__init__()
-        self.dense1 = nn.Linear(in_values, 12673)
+        if input_mode not in ("dense", "bag"):
+            raise ValueError(f"Unknown input mode: {input_mode}")
+        self.config = {"in_values": in_values,
+                       "out_values": out_values,
+                       "hidden_sizes": list(hidden_sizes),
+                       "input_mode": input_mode}
+        self.input_mode = input_mode
+        self.n_hidden = len(hidden_sizes)
+
+        if input_mode == "bag":
+            self.dense1 = nn.EmbeddingBag(in_values, hidden_sizes[0],
+                                          mode="sum")
+            self.bias1 = nn.Parameter(torch.zeros(hidden_sizes[0]))
+        else:
+            self.dense1 = nn.Linear(in_values, hidden_sizes[0])
         self.drop1 = nn.Dropout()
-        self.dense2 = nn.Linear(12673, 4000)
-        self.drop2 = nn.Dropout()
-        self.dense3 = nn.Linear(4000, 500)
-        self.drop3 = nn.Dropout()
-        self.last_dense = nn.Linear(500, out_values)
+        for i in range(1, self.n_hidden):
+            setattr(self, f"dense{i + 1}",
+                    nn.Linear(hidden_sizes[i - 1], hidden_sizes[i]))
+            setattr(self, f"drop{i + 1}", nn.Dropout())
+        self.last_dense = nn.Linear(hidden_sizes[-1], out_values)
+
+    def input_layer(self, x):
+        if self.input_mode == "dense":
+            return self.dense1(x)
+
+        if x.layout != torch.sparse_csr:
+            x = x.to_sparse_csr()
+        offsets = x.crow_indices()[:-1]
+        return self.dense1(x.col_indices(), offsets,
+                           per_sample_weights=x.values()) + self.bias1
 
     def forward(self, x):
-        x = F.relu(self.dense1(x))
+        x = F.relu(self.input_layer(x))
         x = self.drop1(x)
-        x = F.relu(self.dense2(x))
-        x = self.drop2(x)
-        x = F.relu(self.dense3(x))
-        x = self.drop3(x)
+        for i in range(2, self.n_hidden + 1):
+            x = F.relu(getattr(self, f"dense{i}")(x))
+            x = getattr(self, f"drop{i}")(x)
         x = self.last_dense(x)
         return x
 
 
+def is_main_process() -> bool:
+    """Whether the process logs and saves the results: the only
+    process, or the rank 0 of distributed training"""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+class RunningMetrics:
+    """Loss and confusion matrix accumulated batch by batch on the
+    device of the model, so that no extra pass over the data nor
+    synchronization with the CPU is needed to compute them.
+
+    Args:
+        n_classes (int): number of classes
+        device (torch.device): device of the batches
+    """
+    def __init__(self, n_classes: int, device: torch.device):
+        self.n_classes = n_classes
+        self.loss_sum = torch.zeros((), device=device)
+        self.n_batches = 0
+        self.counts = torch.zeros(n_classes * n_classes, dtype=torch.long,
+                                  device=device)
+
+    @torch.no_grad()
+    def update(self, loss: torch.Tensor, y: torch.Tensor,
+               y_pred: torch.Tensor) -> None:
+        """Adds a batch: its mean loss, its labels and its logits"""
+        self.loss_sum += loss.detach()
+        self.n_batches += 1
+        pairs = y * self.n_classes + y_pred.argmax(dim=1)
+        self.counts += torch.bincount(pairs,
+                                      minlength=self.n_classes ** 2)
+
+    def all_reduce(self) -> "RunningMetrics":
+        """Sums the metrics of every process of distributed training,
+        so that every process gets those of the whole set"""
+        if dist.is_initialized():
+            n_batches = torch.tensor(self.n_batches,
+                                     device=self.loss_sum.device)
+            for tensor in (self.loss_sum, self.counts, n_batches):
+                dist.all_reduce(tensor)
+            self.n_batches = int(n_batches)
+        return self
+
+    def loss(self) -> float:
+        return self.loss_sum.item() / max(self.n_batches, 1)
+
+    def confusion_matrix(self) -> np.ndarray:
+        return self.counts.view(self.n_classes, -1).cpu().numpy()
+
+    def report(self, labels: Sequence[str]) -> Dict[str, Any]:
+        """Classification report of the accumulated predictions, the
+        same as sklearn's `classification_report` with `output_dict`"""
+        cm = self.confusion_matrix()
+        classes = np.arange(self.n_classes)
+        # Every (true, predicted) pair weighted by its count
+        return classification_report(np.repeat(classes, self.n_classes),
+                                     np.tile(classes, self.n_classes),
+                                     labels=classes,
+                                     target_names=labels,
+                                     sample_weight=cm.ravel(),
+                                     output_dict=True,
+                                     zero_division=0)
+
+
 @torch.no_grad()
-def evaluate(dl, model, criterion, device, total_it=-1):
+def evaluate(dl, model, criterion, device, n_classes, total_it=-1):
     model.eval()
-
-    eval_loss = 0.0
-    y_true = []
-    y_preds = []
+    metrics = RunningMetrics(n_classes, device)
 
     max_it = len(dl) if total_it == -1 else total_it
     for bn, (X, y) in tqdm(enumerate(dl), unit="batch",
-                           desc=f"Model evaluation (bs={dl.batch_size})"):
+                           desc=f"Model evaluation (bs={dl.batch_size})",
+                           disable=not is_main_process()):
         if bn == max_it:
             break
         X, y = X.to(device), y.to(device)
         y_pred = model(X)
-        loss = criterion(y_pred, y)
-        eval_loss += loss.detach().item()
-        y_true.append(y.detach().cpu().numpy())
-        y_preds.append(y_pred.argmax(dim=1).cpu().numpy())
-    return eval_loss / max_it, np.block(y_true), np.block(y_preds)
+        metrics.update(criterion(y_pred, y), y, y_pred)
+    return metrics.all_reduce()
 
 
-def train_per_epoch(train_dl, model, criterion, optimizer, device):
+def train_per_epoch(train_dl, model, criterion, optimizer, device,
+                    metrics=None):
+    """Trains the model on every batch once. The loss and the
+    predictions of each batch are added to `metrics` as they come, so
+    the training metrics are those of the model being trained (in
+    train mode) over the epoch."""
     model.train()
     for X, y in tqdm(train_dl, unit="batch",
-                     desc="Model fitting"):
+                     desc="Model fitting", disable=not is_main_process()):
         X, y = X.to(device), y.to(device)
 
         optimizer.zero_grad()
@@ -71,48 +181,274 @@ def train_per_epoch(train_dl, model, criterion, optimizer, device):
 
         loss.backward()
         optimizer.step()
+        if metrics is not None:
+            metrics.update(loss, y, y_pred)
+
+
+def save_atomic(obj: Any, path: Path) -> None:
+    """Saves an object with `torch.save` to a temporary file, then
+    renames it over `path`, so an interrupted save never leaves a
+    partial file"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class EarlyStopping:
+    """Keeps the weights of the epoch with the lowest validation loss
+    and tells when it hasn't decreased for `patience` evaluations.
+
+    Args:
+        patience (Optional[int], optional): number of evaluations
+            without improvement before stopping, None to never stop.
+            Defaults to None.
+        best_path (Optional[Path], optional): file where the best
+            weights are saved (by the first process) each time they
+            improve, instead of being kept in memory. Defaults to None.
+    """
+    def __init__(self, patience: Optional[int] = None,
+                 best_path: Optional[Path] = None):
+        self.patience = patience
+        self.best_path = best_path
+        self.best_loss = float("inf")
+        self.best_epoch: Optional[int] = None
+        self.best_state: Optional[Dict[str, torch.Tensor]] = None
+        self.n_stale = 0
+
+    def update(self, epoch: int, loss: float, model: nn.Module) -> bool:
+        """Records the validation loss of an epoch, and the weights of
+        the model if it is the best one so far"""
+        if loss < self.best_loss:
+            self.best_loss, self.best_epoch = loss, epoch
+            self.n_stale = 0
+            if self.best_path is None:
+                self.best_state = {
+                    name: value.detach().cpu().clone()
+                    for name, value in model.state_dict().items()}
+            elif is_main_process():
+                save_atomic(model.state_dict(), self.best_path)
+            return True
+        self.n_stale += 1
+        if self.should_stop and is_main_process():
+            logger.info(f"Early stopping: no better val loss for "
+                        f"{self.n_stale} evaluations")
+        return False
+
+    def best_weights(self) -> Optional[Dict[str, torch.Tensor]]:
+        """The best weights so far, None if unknown (no evaluation, or
+        a best weights file this process can't see)"""
+        if self.best_path is None:
+            return self.best_state
+        if self.best_epoch is None or not self.best_path.exists():
+            return None
+        return torch.load(self.best_path, map_location="cpu")
+
+    @property
+    def should_stop(self) -> bool:
+        return self.patience is not None and self.n_stale >= self.patience
+
+    def state_dict(self) -> Dict[str, Any]:
+        """The progress of the early stopping, without the weights"""
+        return {"best_loss": self.best_loss, "best_epoch": self.best_epoch,
+                "n_stale": self.n_stale}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self.best_loss = state["best_loss"]
+        self.best_epoch = state["best_epoch"]
+        self.n_stale = state["n_stale"]
+
+
+def save_checkpoint(path: Path, model: nn.Module, optimizer, epoch: int,
+                    res_train: Dict[str, Any],
+                    stopper: EarlyStopping) -> None:
+    """Saves the state of a training after an epoch, atomically, from
+    the first process only. The best weights aren't part of it, see
+    `EarlyStopping`."""
+    if is_main_process():
+        save_atomic({"epoch": epoch,
+                     "model": model.state_dict(),
+                     "optimizer": optimizer.state_dict(),
+                     "res_train": res_train,
+                     "early_stopping": stopper.state_dict()}, path)
+
+
+def load_checkpoint(path: Path, model: nn.Module, optimizer, device,
+                    stopper: EarlyStopping) -> Tuple[int, Dict[str, Any]]:
+    """Restores the model, optimizer and early stopping of a training
+    saved by `save_checkpoint`
+
+    Returns:
+        Tuple[int, Dict[str, Any]]: the last trained epoch and the
+            results so far
+    """
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    stopper.load_state_dict(checkpoint["early_stopping"])
+    return checkpoint["epoch"], checkpoint["res_train"]
+
+
+def checkpoint_exists(path: Optional[Path]) -> bool:
+    """Whether a checkpoint exists. In distributed training, every
+    process must see it (or none), otherwise they would resume from
+    different epochs and wait for each other forever."""
+    exists = path is not None and path.exists()
+    if not dist.is_initialized():
+        return exists
+    flags = torch.tensor([int(exists), int(not exists)])
+    dist.all_reduce(flags, op=dist.ReduceOp.MIN)
+    if not flags.any():
+        raise RuntimeError(f"{path} is only visible by some of the "
+                           "processes, resuming needs a model directory "
+                           "shared by every node")
+    return exists
+
+
+def resume_training(checkpoint_path: Optional[Path], model: nn.Module,
+                    optimizer, device, stopper: EarlyStopping
+                    ) -> Tuple[int, Dict[str, Any]]:
+    """Restores a training from its checkpoint if there is one
+
+    Returns:
+        Tuple[int, Dict[str, Any]]: the first epoch to train and the
+            results so far (empty without checkpoint)
+    """
+    if not checkpoint_exists(checkpoint_path):
+        if checkpoint_path is not None and is_main_process():
+            logger.info(f"No checkpoint at {checkpoint_path}, "
+                        "training from scratch")
+        return 0, {split: {"epoch": [], "loss": [], "cm": [], "report": []}
+                   for split in ("train", "val")}
+    last_epoch, res_train = load_checkpoint(checkpoint_path, model,
+                                            optimizer, device, stopper)
+    if is_main_process():
+        logger.info(f"Resuming after epoch {last_epoch} "
+                    f"from {checkpoint_path}")
+    return last_epoch + 1, res_train
 
 
 def train_model(train_dl, val_dl, n_epochs, model,
-                criterion, optimizer, device, labels):
-    res_train = {"train": {"loss": [], "cm": [], "report": []},
-                 "val": {"loss": [], "cm": [], "report": []}}
-    for epoch in trange(n_epochs, unit="epoch"):
-        train_per_epoch(train_dl, model, criterion, optimizer, device)
-
-        tot_it = len(val_dl)*val_dl.batch_size // train_dl.batch_size
-        train_loss, train_true, train_pred = evaluate(train_dl,
-                                                      model,
-                                                      criterion,
-                                                      device,
-                                                      total_it=tot_it)
-
-        val_loss, val_true, val_pred = evaluate(val_dl,
-                                                model,
-                                                criterion,
-                                                device)
-
-        logger.info(f"EPOCH {epoch}")
-        logger.info(f"Train loss: {train_loss} / Val loss: {val_loss}")
-        res_train["train"]["loss"].append(train_loss)
-        res_train["val"]["loss"].append(val_loss)
-
-        res_train["train"]["cm"].append(confusion_matrix(train_true,
-                                                         train_pred))
-        res_train["val"]["cm"].append(confusion_matrix(val_true,
-                                                       val_pred))
-
-        train_report = classification_report(train_true,
-                                             train_pred,
-                                             target_names=labels,
-                                             output_dict=True)
-        val_report = classification_report(val_true,
-                                           val_pred,
-                                           target_names=labels,
-                                           output_dict=True)
-        res_train["train"]["report"].append(train_report)
-        res_train["val"]["report"].append(val_report)
-        logger.info(f"Train Accuracy: {train_report['accuracy']} / "
-                    f"Val accuracy: {val_report['accuracy']}")
+                criterion, optimizer, device, labels, eval_every=1,
+                checkpoint_path=None, checkpoint_every=1, resume=False,
+                patience=None, best_path=None):
+    """Trains the model for `n_epochs` epochs.
+
+    The training metrics are accumulated during the training pass of
+    each epoch. The validation set is evaluated every `eval_every`
+    epochs and after the last one. In distributed training, the
+    metrics are those of all the processes, logged by the first one.
+
+    With a `checkpoint_path`, the model, the optimizer, the results
+    and the early stopping state are saved there every
+    `checkpoint_every` epochs and at the end, and `resume` restarts
+    from the saved epoch. The training stops once the validation loss
+    hasn't decreased for `patience` evaluations, and the model ends
+    with the weights of its best evaluated epoch, saved in
+    `best_path` whenever they improve (kept in memory without it).
+
+    Returns:
+        dict: for `train` and `val`, the evaluated `epoch`s and their
+            `loss`, confusion matrix (`cm`) and classification
+            `report`, and the `best_epoch`
+    """
+    # The weights and optimizer states of a DDP model are those of its
+    # wrapped module
+    module = getattr(model, "module", model)
+    stopper = EarlyStopping(patience, best_path)
+    start_epoch, res_train = resume_training(
+        checkpoint_path if resume else None, module, optimizer, device,
+        stopper)
 
+    def record(split, epoch, metrics):
+        res_train[split]["epoch"].append(epoch)
+        res_train[split]["loss"].append(metrics.loss())
+        res_train[split]["cm"].append(metrics.confusion_matrix())
+        res_train[split]["report"].append(metrics.report(labels))
+
+    main_process = is_main_process()
+    for epoch in trange(start_epoch, n_epochs, unit="epoch",
+                        disable=not main_process):
+        if stopper.should_stop:
+            break
+        train_metrics = RunningMetrics(len(labels), device)
+        train_per_epoch(train_dl, model, criterion, optimizer, device,
+                        metrics=train_metrics)
+        record("train", epoch, train_metrics.all_reduce())
+        train_report = res_train["train"]["report"][-1]
+        if main_process:
+            logger.info(f"EPOCH {epoch}")
+            logger.info(f"Train loss: {res_train['train']['loss'][-1]} / "
+                        f"Train accuracy: {train_report['accuracy']}")
+
+        if not (epoch + 1) % eval_every or epoch == n_epochs - 1:
+            record("val", epoch, evaluate(val_dl, model, criterion, device,
+                                          len(labels)))
+            val_report = res_train["val"]["report"][-1]
+            stopper.update(epoch, res_train["val"]["loss"][-1], module)
+            if main_process:
+                logger.info(f"Val loss: {res_train['val']['loss'][-1]} / "
+                            f"Val accuracy: {val_report['accuracy']}")
+
+        last = epoch == n_epochs - 1 or stopper.should_stop
+        if checkpoint_path is not None and \
+                (last or not (epoch + 1) % checkpoint_every):
+            save_checkpoint(checkpoint_path, module, optimizer, epoch,
+                            res_train, stopper)
+
+    best_weights = stopper.best_weights()
+    if best_weights is not None:
+        module.load_state_dict(best_weights)
+        if main_process:
+            logger.info(f"Keeping the weights of epoch {stopper.best_epoch} "
+                        f"(val loss {stopper.best_loss})")
+    res_train["best_epoch"] = stopper.best_epoch
     return res_train
+
+
+def to_dense_input(model: SimpleNN) -> SimpleNN:
+    """Converts a network with an `EmbeddingBag` input into the same
+    network with a `Linear` input: the weighted sum of the embeddings
+    of the words is the product of the features with the embeddings.
+
+    Args:
+        model (SimpleNN): the network
+
+    Returns:
+        SimpleNN: the network with a dense input (the network itself
+            if its input is already dense)
+    """
+    if model.input_mode == "dense":
+        return model
+    config = dict(model.config, input_mode="dense")
+    dense = SimpleNN(**config)
+    state = model.state_dict()
+    state["dense1.weight"] = state.pop("dense1.weight").t().contiguous()
+    state["dense1.bias"] = state.pop("bias1")
+    dense.load_state_dict(state)
+    return dense
+
+
+def export_torchscript(model: SimpleNN,
+                       quantize: bool = True) -> torch.jit.ScriptModule:
+    """Exports a trained network for CPU inference: its input layer is
+    made dense, its linear layers are dynamically quantized to int8
+    (weights stored as int8, activations quantized on the fly) and it
+    is traced to TorchScript, so that it is run without its Python
+    class.
+
+    Args:
+        model (SimpleNN): the trained network
+        quantize (bool, optional): whether the linear layers are
+            quantized. Defaults to True.
+
+    Returns:
+        torch.jit.ScriptModule: the module taking dense float32
+            features and returning logits
+    """
+    model = to_dense_input(model.cpu()).eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8)
+    example = torch.zeros(1, model.config["in_values"])
+    with torch.no_grad():
+        return torch.jit.trace(model, example)
@@ -0,0 +1,85 @@
+import io
+import numpy as np
+import scipy.sparse as sp
+import torch
+from typing import Sequence
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+# Maximum number of values of a dense batch given to the network
+MAX_BATCH_VALUES = 1 << 24
+
+
+class TorchClassifier(ClassifierMixin, BaseEstimator):
+    """Classifier wrapping an exported network (TorchScript module,
+    see `src.models.nn_model.export_torchscript`), so that it is the
+    last step of a pipeline after its vectorizer and is served like
+    the scikit-learn models. The predictions use the torch threads
+    of the process, which are left to the server (ex. with
+    `OMP_NUM_THREADS`).
+
+    The features are densified by batches of at most
+    `MAX_BATCH_VALUES` values. The module is pickled as its
+    TorchScript archive, so the pipeline is a joblib artifact like
+    the others.
+
+    Args:
+        module (torch.jit.ScriptModule): the exported network, taking
+            dense float32 features and returning logits
+        classes (Sequence[int], optional): class of each logit.
+            Defaults to (0, 1).
+    """
+    def __init__(self, module: torch.jit.ScriptModule,
+                 classes: Sequence[int] = (0, 1)):
+        self.module = module
+        self.classes = classes
+
+    @property
+    def classes_(self) -> np.ndarray:
+        return np.asarray(self.classes)
+
+    def __sklearn_is_fitted__(self) -> bool:
+        return True
+
+    def fit(self, X, y=None):
+        return self
+
+    def logits(self, X) -> np.ndarray:
+        batch_size = max(1, MAX_BATCH_VALUES // X.shape[1])
+        logits = []
+        with torch.inference_mode():
+            for start in range(0, X.shape[0], batch_size):
+                batch = X[start:start + batch_size]
+                if sp.issparse(batch):
+                    batch = batch.toarray()
+                batch = torch.from_numpy(np.asarray(batch, dtype=np.float32))
+                logits.append(self.module(batch).numpy())
+        if not logits:
+            return np.zeros((0, len(self.classes)), dtype=np.float32)
+        return np.concatenate(logits)
+
+    def decision_function(self, X) -> np.ndarray:
+        """Margin of the positive class over the negative one"""
+        logits = self.logits(X)
+        return logits[:, 1] - logits[:, 0]
+
+    def predict_proba(self, X) -> np.ndarray:
+        logits = self.logits(X)
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[self.logits(X).argmax(axis=1)]
+
+    def archive_size(self) -> int:
+        """Size in bytes of the TorchScript archive of the module"""
+        return len(self.__getstate__()["module"])
+
+    def __getstate__(self):
+        buffer = io.BytesIO()
+        torch.jit.save(self.module, buffer)
+        return dict(self.__dict__, module=buffer.getvalue())
+
+    def __setstate__(self, state):
+        state = dict(state)
+        state["module"] = torch.jit.load(io.BytesIO(state["module"]))
+        self.__dict__.update(state)
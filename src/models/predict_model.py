@@ -1,36 +1,24 @@
-import unicodedata
-import string
-from nltk import stem
-from nltk.corpus import stopwords
+from typing import List, Union
+from sklearn.base import BaseEstimator
+from src.features.build_features import get_cleaner
+from src.models.serving import has_cleaner
 
 
-def clean_text(txt: str,
-               stemmer: stem.api.StemmerI
-               ) -> str:
-    """Preprocesses the text to make it suitable for NLP
-    algorithms. Adapted for French comments.
+def make_ml_prediction(y_input: Union[str, List[str]],
+                       model: BaseEstimator) -> list:
+    """Predicts raw comments with a text pipeline, cleaning them
+    first unless the pipeline does it itself
 
     Args:
-        txt (str): original text
-        stemmer (stem.api.StemmerI): NLTK stemmer for stemming
+        y_input (Union[str, List[str]]): a comment or a list of comments
+        model (BaseEstimator): the fitted pipeline
 
     Returns:
-        str: cleaned text
+        list: one prediction per comment
     """
-    sw = set(stopwords.words('french'))
-    new_txt = ''.join([c.lower() if c not in string.punctuation else ' ' for c
-                       in txt])
-    new_txt = (unicodedata.normalize('NFKD', new_txt)
-               .encode('ascii', 'ignore')
-               .decode('utf-8', 'ignore'))
-    new_txt = " ".join([word for word in new_txt.split()
-                        if word and word not in sw])
-    new_txt = ' '.join([stemmer.stem(word) for word in new_txt.split()])
-    return new_txt
-
-
-def make_ml_prediction(y_input, model):
-    stemmer = stem.regexp.RegexpStemmer('s$|es$|era$|erez$|ions$| <etc> ')
-    y_clean = clean_text(y_input, stemmer)
-    y_pred = model.predict(y_clean)
-    return y_pred
+    if isinstance(y_input, str):
+        y_input = [y_input]
+    if not has_cleaner(model):
+        y_input = get_cleaner().clean_batch(y_input)
+    y_pred = model.predict(y_input)
+    return list(y_pred)
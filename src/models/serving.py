@@ -0,0 +1,400 @@
+import json
+import os
+import shutil
+import time
+import numpy as np
+import scipy.sparse as sp
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+from joblib import dump, load
+from sklearn.base import BaseEstimator, ClassifierMixin, TransformerMixin
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import normalize
+from sklearn.svm import SVC, LinearSVC
+from src.features.build_features import CleanerTransformer
+
+# Version of the compact artifact format, see `save_compact`
+COMPACT_FORMAT = 1
+
+# File of a compact artifact naming its current version directory
+CURRENT_FILE = "CURRENT"
+
+# Parameters of the `TfidfVectorizer` kept in a compact artifact
+TFIDF_PARAMS = ["lowercase", "strip_accents", "analyzer", "token_pattern",
+                "ngram_range", "stop_words", "binary", "norm",
+                "sublinear_tf"]
+
+
+def is_linear(clf: BaseEstimator) -> bool:
+    """Tells whether a fitted binary classifier decides with a single
+    weight vector (linear SVC, logistic regression...)
+
+    Args:
+        clf (BaseEstimator): a fitted classifier
+
+    Returns:
+        bool: True if `clf` can be replaced by a `LinearDecision`
+    """
+    if isinstance(clf, SVC):
+        linear = clf.kernel == "linear"
+    else:
+        linear = isinstance(clf, (LinearSVC, LogisticRegression,
+                                  SGDClassifier))
+    return linear and len(getattr(clf, "classes_", [])) == 2
+
+
+class LinearDecision(BaseEstimator, ClassifierMixin):
+    """Binary linear classifier reduced to its weight vector over the
+    vocabulary and its intercept, so that predicting a text costs one
+    sparse dot product, whatever the number of support vectors of the
+    classifier it comes from.
+
+    Args:
+        coef (np.ndarray): weights of the features
+        intercept (float): the intercept
+        classes (np.ndarray): the two classes, the second one being
+            predicted when the decision is positive
+    """
+    def __init__(self, coef: np.ndarray, intercept: float,
+                 classes: np.ndarray):
+        self.coef = coef
+        self.intercept = intercept
+        self.classes = classes
+        self.coef_ = np.asarray(coef, dtype=np.float64).ravel()
+        self.intercept_ = float(intercept)
+        self.classes_ = np.asarray(classes)
+
+    @classmethod
+    def from_estimator(cls, clf: BaseEstimator) -> "LinearDecision":
+        """Extracts the weights of a fitted linear classifier
+
+        Args:
+            clf (BaseEstimator): a classifier checked by `is_linear`
+
+        Returns:
+            LinearDecision: the equivalent decision
+        """
+        if not is_linear(clf):
+            raise ValueError(f"{clf!r} is not a binary linear classifier")
+        coef = clf.coef_
+        if hasattr(coef, "toarray"):
+            # SVC fitted on sparse features has sparse weights
+            coef = coef.toarray()
+        intercept = float(np.ravel(clf.intercept_)[0])
+        return cls(np.asarray(coef).ravel(), intercept, clf.classes_)
+
+    def fit(self, X, y=None):
+        return self
+
+    def decision_function(self, X) -> np.ndarray:
+        return np.asarray(X @ self.coef_).ravel() + self.intercept_
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[(self.decision_function(X) > 0).astype(int)]
+
+
+def linearize(model: Pipeline) -> Pipeline:
+    """Replaces the linear classifier ending a fitted pipeline by its
+    `LinearDecision`, keeping the preprocessing steps
+
+    Args:
+        model (Pipeline): a fitted pipeline (ex. TF-IDF + linear SVC)
+
+    Returns:
+        Pipeline: the serving pipeline
+    """
+    if not isinstance(model, Pipeline):
+        raise ValueError("Only pipelines can be linearized")
+    decision = LinearDecision.from_estimator(model.steps[-1][1])
+    return Pipeline(model.steps[:-1] + [("lineardecision", decision)])
+
+
+def has_cleaner(model: BaseEstimator) -> bool:
+    """Tells whether a model cleans raw texts itself, see
+    `with_cleaner`"""
+    return isinstance(model, Pipeline) \
+        and isinstance(model.steps[0][1], CleanerTransformer)
+
+
+def with_cleaner(model: Pipeline,
+                 cleaner: Optional[CleanerTransformer] = None) -> Pipeline:
+    """Prepends a cleaning step to a pipeline trained on cleaned
+    texts, so that it predicts raw texts in a single `predict` call
+
+    Args:
+        model (Pipeline): a pipeline fitted on cleaned texts
+        cleaner (Optional[CleanerTransformer], optional): the cleaner
+            of the training texts. Defaults to the default cleaner.
+
+    Returns:
+        Pipeline: the pipeline predicting raw texts
+    """
+    if has_cleaner(model):
+        return model
+    cleaner = cleaner or CleanerTransformer().fit()
+    return Pipeline([("cleaner", cleaner)] + model.steps)
+
+
+def check_parity(model: BaseEstimator, serving_model: BaseEstimator,
+                 texts: Iterable[str]) -> float:
+    """Compares the predictions of a model and of its serving version
+
+    Args:
+        model (BaseEstimator): the original model
+        serving_model (BaseEstimator): the serving model
+        texts (Iterable[str]): cleaned texts
+
+    Returns:
+        float: proportion of identical predictions
+    """
+    texts = list(texts)
+    return float(np.mean(model.predict(texts)
+                         == serving_model.predict(texts)))
+
+
+class CompactTfidf(BaseEstimator, TransformerMixin):
+    """TF-IDF features computed from flat arrays: the terms of the
+    vocabulary sorted as UTF-8 bytes, whose position is the index of
+    their feature, and their IDF weights.
+
+    Unlike the vocabulary dict of a `TfidfVectorizer`, the arrays can
+    be memory-mapped, so loading them is immediate and the processes
+    serving the same artifact share their pages. A term is looked up
+    by binary search in the sorted vocabulary.
+
+    Args:
+        vocabulary (np.ndarray): sorted terms (bytes array)
+        idf (np.ndarray): IDF weight of each term
+        params (Dict[str, Any]): parameters of the original vectorizer,
+            see TFIDF_PARAMS
+    """
+    def __init__(self, vocabulary: np.ndarray, idf: np.ndarray,
+                 params: Dict[str, Any]):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.params = params
+        self._analyze = TfidfVectorizer(**params).build_analyzer()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_analyze"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._analyze = TfidfVectorizer(**self.params).build_analyzer()
+
+    def __sklearn_is_fitted__(self):
+        return True
+
+    @classmethod
+    def from_vectorizer(cls, vectorizer: TfidfVectorizer) -> "CompactTfidf":
+        """Converts a fitted `TfidfVectorizer`"""
+        if callable(vectorizer.analyzer) or vectorizer.preprocessor \
+                or vectorizer.tokenizer:
+            raise ValueError("Custom analyzers can't be exported")
+        terms = vectorizer.get_feature_names_out()
+        vocabulary = np.array([term.encode("utf-8") for term in terms])
+        order = np.argsort(vocabulary)
+        if (order != np.arange(order.size)).any():
+            raise ValueError("The features aren't sorted by term")
+        params = {name: getattr(vectorizer, name) for name in TFIDF_PARAMS}
+        if params["stop_words"] is not None \
+                and not isinstance(params["stop_words"], str):
+            params["stop_words"] = sorted(params["stop_words"])
+        idf = vectorizer.idf_ if vectorizer.use_idf else np.ones(terms.size)
+        return cls(vocabulary, idf, params)
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X: Iterable[str]) -> sp.csr_matrix:
+        indptr = [0]
+        tokens = []
+        for doc in X:
+            tokens.extend(term.encode("utf-8") for term in self._analyze(doc))
+            indptr.append(len(tokens))
+        tokens = np.array(tokens, dtype=bytes)
+
+        positions = np.searchsorted(self.vocabulary, tokens)
+        positions[positions == self.vocabulary.size] = 0
+        known = self.vocabulary[positions] == tokens
+        rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+
+        Xt = sp.csr_matrix((np.ones(known.sum()),
+                            (rows[known], positions[known])),
+                           shape=(len(indptr) - 1, self.vocabulary.size))
+        Xt.sum_duplicates()
+        if self.params["binary"]:
+            Xt.data[:] = 1
+        if self.params["sublinear_tf"]:
+            np.log(Xt.data, Xt.data)
+            Xt.data += 1
+        Xt.data *= self.idf[Xt.indices]
+        if self.params["norm"]:
+            Xt = normalize(Xt, norm=self.params["norm"], copy=False)
+        return Xt
+
+
+def compact_version(path: Union[str, Path]) -> Path:
+    """Directory of the current version of a compact artifact, named
+    by its `CURRENT` file (the artifact itself for the artifacts
+    saved without versions)"""
+    path = Path(path)
+    try:
+        return path / (path / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return path
+
+
+def compact_files(path: Union[str, Path]) -> List[Path]:
+    """Files of the current version of a compact artifact, and the
+    file naming it"""
+    version = compact_version(path)
+    files = sorted(p for p in version.iterdir() if p.is_file())
+    if version != Path(path):
+        files.insert(0, Path(path) / CURRENT_FILE)
+    return files
+
+
+def save_compact(model: Pipeline, path: Union[str, Path]) -> None:
+    """Saves a TF-IDF + linear classifier pipeline as a directory of
+    flat arrays (`vocabulary.npy`, `idf.npy`, `coef.npy`) and a
+    `meta.json` file, loadable by `load_compact`. The configuration
+    of a leading cleaning step is saved in `meta.json`.
+
+    The files are written in a new version directory of the artifact,
+    then its `CURRENT` file is atomically replaced by one naming it,
+    so a reader loads either every file of the previous version or
+    every file of the new one. The previous version is kept for the
+    readers still loading it, the older ones are removed.
+
+    Args:
+        model (Pipeline): a pipeline made of a fitted `TfidfVectorizer`
+            and a linear classifier (see `is_linear`) or its
+            `LinearDecision`, optionally preceded by a cleaner
+        path (Union[str, Path]): the directory (ex. `svm_pipe.compact`)
+    """
+    cleaner = None
+    if has_cleaner(model):
+        cleaner = model.steps[0][1].cleaner_
+        model = model[1:]
+    if not isinstance(model, Pipeline) or len(model.steps) != 2:
+        raise ValueError("Only TF-IDF + classifier pipelines can be saved")
+    vectorizer, clf = model[0], model[-1]
+    if not isinstance(vectorizer, TfidfVectorizer):
+        raise ValueError(f"{vectorizer!r} isn't a TfidfVectorizer")
+    tfidf = CompactTfidf.from_vectorizer(vectorizer)
+    if not isinstance(clf, LinearDecision):
+        clf = LinearDecision.from_estimator(clf)
+
+    meta = {"format": COMPACT_FORMAT,
+            "params": tfidf.params,
+            "intercept": clf.intercept_,
+            "classes": clf.classes_.tolist()}
+    if cleaner is not None:
+        meta["cleaner"] = {"stopwords": sorted(cleaner.stopwords),
+                           "stemmer_pattern": cleaner.stemmer_pattern}
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    previous = compact_version(path).name
+    version = f"v{time.time_ns()}"
+    tmp_dir = path / f"{version}.tmp"
+    tmp_dir.mkdir()
+    for name, array in [("vocabulary", tfidf.vocabulary),
+                        ("idf", tfidf.idf), ("coef", clf.coef_)]:
+        np.save(tmp_dir / f"{name}.npy", array)
+    with open(tmp_dir / "meta.json", "w") as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_dir, path / version)
+
+    with open(path / f"{CURRENT_FILE}.tmp", "w") as f:
+        f.write(version)
+    os.replace(path / f"{CURRENT_FILE}.tmp", path / CURRENT_FILE)
+
+    # Older versions, and the flat files of an unversioned artifact
+    # once replaced (the ones being written by another process are
+    # left alone)
+    for old in path.iterdir():
+        if old.name in (version, previous, CURRENT_FILE) or \
+                old.suffix == ".tmp":
+            continue
+        if old.is_dir():
+            shutil.rmtree(old)
+        else:
+            old.unlink()
+
+
+def load_compact(path: Union[str, Path],
+                 mmap_mode: Optional[str] = "r") -> Pipeline:
+    """Loads an artifact saved by `save_compact`
+
+    Args:
+        path (Union[str, Path]): the directory of the artifact
+        mmap_mode (Optional[str], optional): memory-map mode of the
+            arrays, see `numpy.load`. Defaults to "r".
+
+    Returns:
+        Pipeline: a `CompactTfidf` + `LinearDecision` pipeline,
+            preceded by a `CleanerTransformer` if one was saved
+    """
+    path = compact_version(path)
+    with open(path / "meta.json") as f:
+        meta = json.load(f)
+    if meta["format"] != COMPACT_FORMAT:
+        raise ValueError(f"Unsupported compact format: {meta['format']}")
+
+    params = dict(meta["params"], ngram_range=tuple(
+        meta["params"]["ngram_range"]))
+    tfidf = CompactTfidf(np.load(path / "vocabulary.npy", mmap_mode=mmap_mode),
+                         np.load(path / "idf.npy", mmap_mode=mmap_mode),
+                         params)
+    decision = LinearDecision(np.load(path / "coef.npy", mmap_mode=mmap_mode),
+                              meta["intercept"], np.array(meta["classes"]))
+    steps = [("compacttfidf", tfidf), ("lineardecision", decision)]
+    if "cleaner" in meta:
+        steps.insert(0, ("cleaner", CleanerTransformer(**meta["cleaner"])
+                         .fit()))
+    return Pipeline(steps)
+
+
+def load_model(path: Union[str, Path],
+               mmap_mode: Optional[str] = None) -> BaseEstimator:
+    """Loads a model artifact: a joblib file, or a compact directory
+    saved by `save_compact`
+
+    Args:
+        path (Union[str, Path]): path of the artifact
+        mmap_mode (Optional[str], optional): memory-map mode of the
+            arrays. Defaults to None.
+
+    Returns:
+        BaseEstimator: the model
+    """
+    if Path(path).is_dir():
+        return load_compact(path, mmap_mode=mmap_mode)
+    return load(path, mmap_mode=mmap_mode)
+
+
+def dump_model(model: BaseEstimator, path: Union[str, Path]) -> None:
+    """Saves a joblib artifact atomically: it is written to a
+    temporary file of the same directory, then renamed over the
+    previous artifact. The processes which memory-mapped the previous
+    artifact keep reading its pages, instead of crashing on a
+    truncated file, and a reload never sees a partial artifact.
+
+    Args:
+        model (BaseEstimator): the model
+        path (Union[str, Path]): path of the artifact
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        dump(model, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
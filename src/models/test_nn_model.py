@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from sklearn.metrics import classification_report, confusion_matrix
+from torch.utils.data import DataLoader, TensorDataset
+from .nn_model import RunningMetrics, SimpleNN, train_model
+
+labels = ["Negative", "Positive"]
+
+
+def make_loader():
+    generator = torch.Generator().manual_seed(0)
+    X = torch.randn(64, 10, generator=generator)
+    y = (X[:, 0] > 0).long()
+    return DataLoader(TensorDataset(X, y), batch_size=16)
+
+
+def make_training(lr=0.01):
+    model = SimpleNN(10, 2, hidden_sizes=(8,))
+    return model, torch.optim.Adam(model.parameters(), lr=lr)
+
+
+def test_checkpoint_resume(tmp_path):
+    torch.manual_seed(0)
+    dl = make_loader()
+    checkpoint_path, best_path = tmp_path / "ckpt.pt", tmp_path / "best.pt"
+    kwargs = dict(criterion=nn.CrossEntropyLoss(), device="cpu",
+                  labels=labels, checkpoint_path=checkpoint_path,
+                  best_path=best_path)
+
+    model, optimizer = make_training()
+    train_model(dl, dl, 2, model, optimizer=optimizer, **kwargs)
+    checkpoint = torch.load(checkpoint_path, weights_only=False)
+    assert checkpoint["epoch"] == 1
+    # The best weights are only saved in their own file
+    assert "best_state" not in checkpoint["early_stopping"]
+    assert best_path.exists()
+
+    model, optimizer = make_training()
+    res = train_model(dl, dl, 4, model, optimizer=optimizer, resume=True,
+                      **kwargs)
+    assert res["train"]["epoch"] == [0, 1, 2, 3]
+    assert res["val"]["epoch"] == [0, 1, 2, 3]
+    # The optimizer went on from the 2 epochs of 4 batches already done
+    assert all(state["step"] == 16
+               for state in optimizer.state_dict()["state"].values())
+
+    val_losses = res["val"]["loss"]
+    assert res["best_epoch"] == val_losses.index(min(val_losses))
+    best = torch.load(best_path)
+    assert all(torch.equal(value, best[name])
+               for name, value in model.state_dict().items())
+
+
+def test_patience():
+    dl = make_loader()
+    # Without learning, the val loss never improves after the first epoch
+    model, optimizer = make_training(lr=0)
+    first_weights = {name: value.clone()
+                     for name, value in model.state_dict().items()}
+    res = train_model(dl, dl, 5, model, nn.CrossEntropyLoss(), optimizer,
+                      "cpu", labels, patience=1)
+    assert res["train"]["epoch"] == [0, 1]
+    assert res["best_epoch"] == 0
+    assert all(torch.equal(value, first_weights[name])
+               for name, value in model.state_dict().items())
+
+
+def test_running_metrics():
+    generator = torch.Generator().manual_seed(0)
+    y = torch.tensor([0, 0, 0, 1, 1, 1, 1, 2, 2, 0])
+    logits = torch.randn(len(y), 3, generator=generator)
+    metrics = RunningMetrics(3, torch.device("cpu"))
+    for batch in (slice(0, 4), slice(4, 10)):
+        metrics.update(torch.tensor(0.5), y[batch], logits[batch])
+
+    y_pred = logits.argmax(dim=1).numpy()
+    names = ["a", "b", "c"]
+    assert metrics.loss() == 0.5
+    assert np.array_equal(metrics.confusion_matrix(),
+                          confusion_matrix(y.numpy(), y_pred))
+    expected = classification_report(y.numpy(), y_pred, labels=[0, 1, 2],
+                                     target_names=names, output_dict=True,
+                                     zero_division=0)
+    report = metrics.report(names)
+    assert report.keys() == expected.keys()
+    assert all(report[key] == pytest.approx(value)
+               for key, value in expected.items())
@@ -0,0 +1,34 @@
+import pickle
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+from .nn_model import SimpleNN, export_torchscript, to_dense_input
+from .nn_serving import TorchClassifier
+
+X = sp.random(6, 20, density=0.3, format="csr", dtype=np.float32,
+              random_state=0)
+
+
+def test_to_dense_input():
+    torch.manual_seed(0)
+    model = SimpleNN(20, 2, hidden_sizes=(8, 4), input_mode="bag").eval()
+    dense = to_dense_input(model).eval()
+    with torch.no_grad():
+        expected = model(torch.from_numpy(X.toarray()))
+        assert torch.allclose(dense(torch.from_numpy(X.toarray())),
+                              expected, atol=1e-6)
+
+
+def test_torch_classifier():
+    torch.manual_seed(0)
+    model = SimpleNN(20, 2, hidden_sizes=(256, 256)).eval()
+    clf = TorchClassifier(export_torchscript(model, quantize=False))
+    clf = pickle.loads(pickle.dumps(clf))
+    with torch.no_grad():
+        logits = model(torch.from_numpy(X.toarray())).numpy()
+    assert np.array_equal(clf.predict(X), logits.argmax(axis=1))
+    assert np.allclose(clf.decision_function(X),
+                       logits[:, 1] - logits[:, 0], atol=1e-6)
+    quantized = TorchClassifier(export_torchscript(model))
+    assert quantized.archive_size() < clf.archive_size()
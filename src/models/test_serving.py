@@ -0,0 +1,46 @@
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.pipeline import make_pipeline
+from sklearn.svm import SVC
+from .serving import (check_parity, is_linear, linearize, load_compact,
+                      save_compact)
+
+texts = ["super resto", "plat delicieux", "service lent", "cafe froid",
+         "tres bon accueil", "mauvais plat", "bon dessert", "lent et froid"]
+labels = [1, 1, 0, 0, 1, 0, 1, 0]
+
+
+def test_linearize():
+    model = make_pipeline(TfidfVectorizer(), SVC(kernel="linear"))
+    model.fit(texts, labels)
+    serving_model = linearize(model)
+    assert check_parity(model, serving_model, texts + ["bon mais lent"]) == 1
+    assert np.allclose(serving_model.decision_function(texts),
+                       model.decision_function(texts))
+
+
+def test_is_linear():
+    assert not is_linear(SVC().fit([[0], [1]], [0, 1]))
+    assert is_linear(SVC(kernel="linear").fit([[0], [1]], [0, 1]))
+
+
+def test_compact(tmp_path):
+    model = make_pipeline(TfidfVectorizer(), SVC(kernel="linear"))
+    model.fit(texts, labels)
+    save_compact(model, tmp_path / "svm_pipe.compact")
+    compact = load_compact(tmp_path / "svm_pipe.compact")
+    new_texts = texts + ["bon mais lent", "", "crème brûlée"]
+    assert abs(compact[0].transform(new_texts)
+               - model[0].transform(new_texts)).max() < 1e-12
+    assert check_parity(model, compact, new_texts) == 1
+
+
+def test_compact_versions(tmp_path):
+    path = tmp_path / "svm_pipe.compact"
+    for flipped in [False, True, False, True]:
+        y = [1 - label for label in labels] if flipped else labels
+        model = make_pipeline(TfidfVectorizer(), SVC(kernel="linear"))
+        save_compact(model.fit(texts, y), path)
+    # The current version and the previous one are kept
+    assert len([p for p in path.iterdir() if p.is_dir()]) == 2
+    assert check_parity(model, load_compact(path), texts) == 1
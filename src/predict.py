@@ -0,0 +1,172 @@
+import click
+import logging
+import time
+import datetime as dt
+import coloredlogs
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Iterator, Optional
+from sklearn.base import BaseEstimator
+from src.api.inference import predict_texts
+from src.data.stream import imap_bounded
+from src.features.build_features import TextCleaner
+from src.models.serving import has_cleaner, load_model
+
+# Suffixes of the JSON Lines files, the other files being CSV
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+
+# Model and cleaner of the processes of the pool, see `main`
+_worker_model: Optional[BaseEstimator] = None
+_worker_cleaner: Optional[TextCleaner] = None
+
+
+def _init_worker(model_path: str, cleaner: Optional[TextCleaner]) -> None:
+    global _worker_model, _worker_cleaner
+    # The arrays of the model are shared by the processes
+    _worker_model = load_model(model_path, mmap_mode="r")
+    _worker_cleaner = cleaner
+
+
+def read_chunks(path: Path, chunksize: int) -> Iterator[pd.DataFrame]:
+    """Streams a CSV or JSON Lines file (`.jsonl`) by chunks"""
+    if path.suffix in JSONL_SUFFIXES:
+        return pd.read_json(path, lines=True, chunksize=chunksize)
+    return pd.read_csv(path, chunksize=chunksize)
+
+
+def write_chunk(chunk: pd.DataFrame, path: Path, first: bool,
+                jsonl: bool = False) -> None:
+    """Appends a chunk to a CSV or JSON Lines file"""
+    if jsonl:
+        with open(path, "w" if first else "a", encoding="utf-8") as f:
+            chunk.to_json(f, orient="records", lines=True,
+                          force_ascii=False)
+    else:
+        chunk.to_csv(path, mode="w" if first else "a", header=first,
+                     index=None)
+
+
+def score_chunk(chunk: pd.DataFrame,
+                text_column: str,
+                with_scores: bool,
+                model: Optional[BaseEstimator] = None,
+                cleaner: Optional[TextCleaner] = None) -> pd.DataFrame:
+    """Cleans and predicts the comments of a chunk in one batch
+
+    Args:
+        chunk (pd.DataFrame): chunk of the input file
+        text_column (str): column of the comments
+        with_scores (bool): whether to add the decision scores
+        model (Optional[BaseEstimator], optional): the model.
+            Defaults to the model of the pool process.
+        cleaner (Optional[TextCleaner], optional): the cleaner, None
+            if the comments are already cleaned. Defaults to the
+            cleaner of the pool process.
+
+    Returns:
+        pd.DataFrame: the chunk with a `prediction` column, and a
+            `score` column if asked
+    """
+    model = model or _worker_model
+    cleaner = cleaner or _worker_cleaner
+    texts = chunk[text_column].fillna('').astype(str)
+    if cleaner is not None:
+        texts = cleaner.clean_batch(texts)
+
+    predictions, scores = predict_texts(model, texts,
+                                        with_scores=with_scores)
+    chunk = chunk.copy()
+    chunk["prediction"] = predictions
+    if with_scores:
+        chunk["score"] = scores
+    return chunk
+
+
+@click.command()
+@click.argument('input_path', type=click.Path(exists=True))
+@click.argument('model_path', type=click.Path(exists=True))
+@click.argument('output_path', type=click.Path())
+@click.option("--text-column", "-t", default="comment",
+              help="Column of the comments")
+@click.option("--clean/--no-clean", default=True,
+              help=("Cleans the comments (--no-clean if already cleaned), "
+                    "unless the model cleans them itself"))
+@click.option("--scores/--no-scores", "with_scores", default=True,
+              help="Adds the decision scores")
+@click.option("--chunksize", "-cs", type=int, default=10000,
+              help="Number of comments read and scored at once")
+@click.option("--workers", "-w", type=int, default=1,
+              help="Number of processes scoring the chunks")
+def main(input_path: str,
+         model_path: str,
+         output_path: str,
+         text_column: str = "comment",
+         clean: bool = True,
+         with_scores: bool = True,
+         chunksize: int = 10000,
+         workers: int = 1
+         ) -> None:
+    """ Scores the comments of a CSV or JSON Lines file with a model
+        (joblib pipeline or compact artifact), without the API.
+
+        The file is streamed by chunks: each chunk is cleaned and
+        predicted in one batch, by a pool of processes with
+        `--workers`, and written to OUTPUT_PATH (CSV or `.jsonl`) in
+        the original order as soon as it is scored, so only a few
+        chunks are in memory at once.
+    """
+    logger = logging.getLogger('predict')
+    start_time = time.time()
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+
+    model = load_model(model_path, mmap_mode="r")
+    if clean and has_cleaner(model):
+        logger.info("The model cleans the comments itself")
+        clean = False
+    cleaner = TextCleaner() if clean else None
+    chunks = read_chunks(input_path, chunksize)
+    score_fn = partial(score_chunk, text_column=text_column,
+                       with_scores=with_scores)
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers,
+                                       initializer=_init_worker,
+                                       initargs=(model_path, cleaner))
+    else:
+        score_fn = partial(score_fn, model=model, cleaner=cleaner)
+    logger.info(f"Scoring {input_path} with {model_path} by chunks of "
+                f"{chunksize} comments, {workers} worker(s)")
+
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    jsonl = output_path.suffix in JSONL_SUFFIXES
+    n_lines = 0
+    try:
+        scored = imap_bounded(score_fn, chunks, executor=executor,
+                              max_pending=2 * workers)
+        for i, chunk in enumerate(scored):
+            write_chunk(chunk, tmp_path, first=i == 0, jsonl=jsonl)
+            n_lines += chunk.shape[0]
+            logger.info(f"{n_lines} comments scored")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if n_lines == 0:
+        write_chunk(pd.DataFrame(), tmp_path, first=True, jsonl=jsonl)
+    tmp_path.replace(output_path)
+    elapsed = time.time() - start_time
+    logger.info(f"Predictions saved at {output_path}")
+    logger.info(f"{n_lines} comments in {dt.timedelta(seconds=elapsed)} "
+                f"({n_lines / max(elapsed, 1e-9):.0f} comments/s)")
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    coloredlogs.install()
+
+    main()
@@ -1,17 +1,68 @@
 import click
 import logging
+import os
 import numpy as np
 import pandas as pd
 import json
 import time
 import datetime as dt
+import tempfile
 import coloredlogs
-from joblib import dump, load
+from joblib import Parallel, delayed, load, parallel_config
 from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+from sklearn.base import BaseEstimator
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
-from models.ml_model import generate_best_model
+from models.ml_model import FeatureCache, generate_best_model
 from visualization.visualize import plot_confusion_matrix
+# Imported from the `src` package, which the saved pipelines
+# reference to be loadable by the APIs
+from src.features.build_features import CleanerTransformer
+from src.models.serving import dump_model, has_cleaner, with_cleaner
+
+
+def search_model(model_abbr: str,
+                 X: np.ndarray,
+                 y: np.ndarray,
+                 cache: FeatureCache,
+                 search: str,
+                 n_jobs: int,
+                 seed: int,
+                 vectorizer: str = "tfidf",
+                 n_features: int = 2 ** 18
+                 ) -> Tuple[BaseEstimator, float, float]:
+    """Runs the hyperparameter search of a model and times it. The
+    candidates are fitted in `n_jobs` processes, even when the search
+    itself runs in a joblib worker (see --parallel-models), where
+    joblib would otherwise fit them in threads.
+
+    Returns:
+        Tuple[BaseEstimator, float, float]: the best model, its score
+            and the wall time of the search in seconds
+    """
+    start = time.perf_counter()
+    with parallel_config(backend="loky"):
+        model, model_score = generate_best_model(model_abbr, X, y,
+                                                 cache=cache,
+                                                 search=search,
+                                                 n_jobs=n_jobs,
+                                                 random_state=seed,
+                                                 vectorizer=vectorizer,
+                                                 n_features=n_features)
+    return model, model_score, time.perf_counter() - start
+
+
+@contextmanager
+def feature_cache_dir(feature_cache: Optional[str]) -> Iterator[str]:
+    """Directory of the feature cache: `feature_cache`, kept after the
+    training, or a temporary directory removed even if it fails"""
+    if feature_cache:
+        yield feature_cache
+    else:
+        with tempfile.TemporaryDirectory(prefix="feature-cache-") as tmp:
+            yield tmp
 
 
 @click.command()
@@ -20,10 +71,39 @@ from visualization.visualize import plot_confusion_matrix
 @click.option("--compare-models", "-cm", "comp_model",
               type=click.Path(exists=True))
 @click.option("--random-seed", "-rs", "seed", type=int, default=32451365)
+@click.option("--feature-cache", "-fc", "feature_cache",
+              type=click.Path(file_okay=False), default=None,
+              help=("Keeps the TF-IDF features of the folds in this "
+                    "directory (temporary directory otherwise)"))
+@click.option("--search", "-s", "search",
+              type=click.Choice(["grid", "halving", "random"]),
+              default="grid", help="Hyperparameter search strategy")
+@click.option("--n-jobs", "-j", "n_jobs", type=int, default=1,
+              help="Number of cores used by the searches (-1 for all)")
+@click.option("--parallel-models/--sequential-models", default=False,
+              help=("Runs the searches of the models concurrently, the "
+                    "--n-jobs cores being split between them"))
+@click.option("--fuse-cleaner/--no-fuse-cleaner", default=True,
+              help=("Saves the cleaner in the pipelines, so that they "
+                    "predict raw comments"))
+@click.option("--vectorizer", "-v", "vectorizer",
+              type=click.Choice(["tfidf", "hashing"]), default="tfidf",
+              help=("TF-IDF on a learned vocabulary, or on hashed words "
+                    "(fixed dimension and memory, see --n-features)"))
+@click.option("--n-features", "-nf", "n_features", type=int,
+              default=2 ** 18,
+              help="Number of columns of the hashing vectorizer")
 def main(csv_path: str,
          model_path: str,
          comp_model: str,
-         seed: int = 32451365
+         seed: int = 32451365,
+         feature_cache: str = None,
+         search: str = "grid",
+         n_jobs: int = 1,
+         parallel_models: bool = False,
+         fuse_cleaner: bool = True,
+         vectorizer: str = "tfidf",
+         n_features: int = 2 ** 18
          ) -> None:
     rng = np.random.RandomState(seed)
     start_time = time.time()
@@ -62,38 +142,86 @@ def main(csv_path: str,
     if comp_model:
         list_models["old_model"] = "Old model"
 
-    for model_abbr, model_name in list_models.items():
-        logger.info(f"Beginning estimation of {model_name}")
-        if model_abbr == "old_model":
-            model = load(comp_model)
-            logger.info(f"Retrieved {model_name} at {comp_model}")
+    # The folds are the same for every model, so their features are
+    # computed once and reused by every candidate of every model
+    with feature_cache_dir(feature_cache) as cache_dir:
+        cache = FeatureCache(cache_dir)
+        logger.info(f"Caching TF-IDF features in {cache_dir}")
+
+        # The models are searched on the cleaned comments of the CSV, the
+        # cleaner is only prepended to the saved pipelines
+        cleaner = CleanerTransformer().fit() if fuse_cleaner else None
+
+        searched_models = [abbr for abbr in list_models if abbr != "old_model"]
+        n_cores = os.cpu_count() if n_jobs == -1 else n_jobs
+        if parallel_models:
+            # Each search runs in its own worker process, the cores being
+            # split between the searches run concurrently
+            n_workers = min(n_cores, len(searched_models))
+            jobs_per_model = max(1, n_cores // n_workers)
+            if n_workers == 1:
+                logger.warning("--parallel-models on a single core (see "
+                               "--n-jobs): the searches run one by one")
+            logger.info(f"Searching {', '.join(searched_models)} concurrently "
+                        f"({search} search, {n_workers} process(es), "
+                        f"{jobs_per_model} core(s) each)")
+            searches = Parallel(n_jobs=n_workers)(
+                delayed(search_model)(abbr, X_train, y_train, cache,
+                                      search, jobs_per_model, seed,
+                                      vectorizer, n_features)
+                for abbr in searched_models)
+            searches = dict(zip(searched_models, searches))
         else:
-            model, model_score = generate_best_model(model_abbr,
-                                                     X_train, y_train)
-            logger.info(f"Generated {model_name} with score of {model_score}")
-            model_joblib = model_path / f'{model_abbr}_pipe.joblib'
-            dump(model, model_joblib)
-            logger.info(f"{model_name} saved at {model_joblib}")
-
-        model_cr = classification_report(y_test,
-                                         model.predict(X_test),
-                                         target_names=labels,
-                                         output_dict=True)
-
-        with open(model_path / f'{model_abbr}_results.json', 'w') as f:
-            json.dump(model_cr, f, indent=4)
-
-        logger.info(f"{model_name} accuracy: {model_cr['accuracy']}")
-        for label in labels:
-            lab_metrics = model_cr[label]
-            logger.info(f"CLASS {label.upper()}")
-            for k, v in lab_metrics.items():
-                logger.info(f"{model_name} {k}: {v}")
-
-        plot_confusion_matrix(y_test, model.predict(X_test),
-                              labels=labels,
-                              fn=model_path / f'{model_abbr}_cm.png')
-        logger.info(f"Confusion matrix for {model_name} plotted")
+            searches = {}
+
+        for model_abbr, model_name in list_models.items():
+            logger.info(f"Beginning estimation of {model_name}")
+            if model_abbr == "old_model":
+                model = load(comp_model)
+                logger.info(f"Retrieved {model_name} at {comp_model}")
+            else:
+                if model_abbr not in searches:
+                    logger.info(f"{search.capitalize()} search on "
+                                f"{n_cores} core(s)")
+                    searches[model_abbr] = search_model(
+                        model_abbr, X_train, y_train, cache, search, n_jobs,
+                        seed, vectorizer, n_features)
+                model, model_score, search_time = searches[model_abbr]
+                logger.info(f"Generated {model_name} with score of "
+                            f"{model_score}")
+                logger.info(f"{model_name} search wall time: "
+                            f"{dt.timedelta(seconds=search_time)}")
+                stats = cache.stats()
+                logger.info(f"Feature cache: {stats['hits']} hits / "
+                            f"{stats['misses']} misses so far")
+                model_joblib = model_path / f'{model_abbr}_pipe.joblib'
+                dump_model(with_cleaner(model, cleaner) if fuse_cleaner
+                           else model, model_joblib)
+                logger.info(f"{model_name} saved at {model_joblib}")
+
+            if has_cleaner(model):
+                # The test comments are already cleaned
+                model = model[1:]
+
+            model_cr = classification_report(y_test,
+                                             model.predict(X_test),
+                                             target_names=labels,
+                                             output_dict=True)
+
+            with open(model_path / f'{model_abbr}_results.json', 'w') as f:
+                json.dump(model_cr, f, indent=4)
+
+            logger.info(f"{model_name} accuracy: {model_cr['accuracy']}")
+            for label in labels:
+                lab_metrics = model_cr[label]
+                logger.info(f"CLASS {label.upper()}")
+                for k, v in lab_metrics.items():
+                    logger.info(f"{model_name} {k}: {v}")
+
+            plot_confusion_matrix(y_test, model.predict(X_test),
+                                  labels=labels,
+                                  fn=model_path / f'{model_abbr}_cm.png')
+            logger.info(f"Confusion matrix for {model_name} plotted")
 
     end_time = time.time()
     tot_time = str(dt.timedelta(seconds=end_time-start_time))
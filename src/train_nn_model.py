@@ -1,18 +1,30 @@
 import click
+import json
 import logging
+import os
+import socket
 import time
 import datetime as dt
 import coloredlogs
 import pickle
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.optim as optim
+from joblib import dump
 from pathlib import Path
-from typing import Tuple
+from sklearn.base import BaseEstimator
+from torch.nn.parallel import DistributedDataParallel
+from typing import Any, Dict, List, Optional, Tuple
 from data.dataset import CommentDataset, get_dataloaders
 from models.nn_model import SimpleNN, train_model
 from visualization.visualize import plot_cm_nn, plot_loss_acc
 
+# Maximum number of weights of the input layer with the hashing
+# vectorizer (1 GiB in fp32), whose size doesn't depend on the corpus
+MAX_INPUT_WEIGHTS = 2 ** 28
+
 
 @click.command()
 @click.argument('csv_path', type=click.Path(exists=True))
@@ -21,40 +33,117 @@ from visualization.visualize import plot_cm_nn, plot_loss_acc
               nargs=2, type=click.Tuple([int, int]))
 @click.option("--epochs", "-ep", "n_epochs", type=int)
 @click.option("--random-seed", "-rs", "seed", type=int, default=32451365)
+@click.option("--num-workers", "-nw", "num_workers", type=int, default=0,
+              help="Number of processes preparing the batches")
+@click.option("--hidden-sizes", "-hs", "hidden_sizes", type=int,
+              multiple=True, default=(12673, 4000, 500),
+              help="Size of a hidden layer (repeat for each layer)")
+@click.option("--input-mode", "-im", "input_mode",
+              type=click.Choice(["dense", "bag"]), default="dense",
+              help="Dense input layer or TF-IDF weighted EmbeddingBag")
+@click.option("--vectorizer", "-v", "vectorizer",
+              type=click.Choice(["tfidf", "hashing"]), default="tfidf",
+              help=("TF-IDF on a learned vocabulary, or on hashed words "
+                    "(fixed input size, see --n-features)"))
+@click.option("--n-features", "-nf", "n_features", type=int,
+              default=2 ** 14,
+              help="Number of inputs with the hashing vectorizer")
+@click.option("--eval-every", "-ee", "eval_every", type=click.IntRange(min=1),
+              default=1,
+              help="Evaluates the validation set every N epochs")
+@click.option("--feature-cache/--no-feature-cache", default=True,
+              help=("Saves the vectorizer and the features in a `features` "
+                    "directory next to the CSV, reused while the CSV is "
+                    "unchanged"))
+@click.option("--checkpoint-every", "-ce", "checkpoint_every", type=int,
+              default=1,
+              help=("Saves a checkpoint in MODEL_PATH every N epochs "
+                    "(0 to never save one)"))
+@click.option("--resume/--no-resume", default=False,
+              help="Resumes the training from the checkpoint of MODEL_PATH")
+@click.option("--patience", "-pa", "patience", type=int, default=None,
+              help=("Stops after N evaluations without a better val loss "
+                    "(the weights of the best one are kept)"))
+@click.option("--nprocs", "-np", "nprocs", type=int, default=1,
+              help=("Number of processes training the model on CPU "
+                    "(the batch sizes are per process)"))
 def main(csv_path: str,
          model_path: str,
          bs: Tuple[int, int],
          n_epochs: int,
-         seed: int
+         seed: int,
+         num_workers: int = 0,
+         hidden_sizes: Tuple[int, ...] = (12673, 4000, 500),
+         input_mode: str = "dense",
+         vectorizer: str = "tfidf",
+         n_features: int = 2 ** 14,
+         eval_every: int = 1,
+         feature_cache: bool = True,
+         checkpoint_every: int = 1,
+         resume: bool = False,
+         patience: Optional[int] = None,
+         nprocs: int = 1
          ) -> None:
-    start_time = time.time()
-    logger = logging.getLogger('ml-model')
-    logger.info("Begin training on Deep learning model")
-    torch.manual_seed(seed)
+    """ Trains the neural network on the cleaned comments of CSV_PATH
+        and saves it with its results in the MODEL_PATH directory.
 
-    model_path = Path(model_path)
+        With --nprocs N, N processes of this machine train it with
+        `DistributedDataParallel` (gloo backend, on CPU), each one on
+        a shard of the data. Launched by `torchrun` (torch >= 1.10,
+        installed by `make requirements`), the processes of every node
+        take part in the training instead.
+    """
+    if (vectorizer == "hashing"
+            and n_features * hidden_sizes[0] > MAX_INPUT_WEIGHTS):
+        raise click.ClickException(
+            f"An input layer of {n_features} x {hidden_sizes[0]} weights "
+            f"takes {n_features * hidden_sizes[0] * 4 / 2 ** 30:.1f} GiB, "
+            "lower --n-features or the first --hidden-sizes")
+    config = dict(csv_path=csv_path, model_path=Path(model_path), bs=bs,
+                  n_epochs=n_epochs, seed=seed, num_workers=num_workers,
+                  hidden_sizes=hidden_sizes, input_mode=input_mode,
+                  vectorizer=vectorizer, n_features=n_features,
+                  eval_every=eval_every,
+                  checkpoint_every=checkpoint_every, resume=resume,
+                  patience=patience,
+                  cache_dir=(Path(csv_path).parent / "features"
+                             if feature_cache else None))
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        # Launched by torchrun, which sets the rank and the rendezvous
+        train(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]),
+              config)
+    elif nprocs > 1:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", str(free_port()))
+        mp.spawn(train, args=(nprocs, config), nprocs=nprocs)
+    else:
+        train(0, 1, config)
 
-    ds = CommentDataset(csv_path)
-    logger.info(f"Loaded dataset of {len(ds)} samples.")
-    logger.info(f"Dataset labels: {ds.labels}")
-    n_words = ds[0][0].shape[0]
-    logger.info(f"N° of words: {n_words}")
 
-    logger.info(f"Loading dataloaders with batch sizes {bs}")
-    train_dl, val_dl = get_dataloaders(ds, bs, train_size=0.8)
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
 
-    logger.info(f"Loading NN model with input {n_words}, output 2")
-    model = SimpleNN(n_words, 2)
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(model.parameters(), lr=1e-3)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    logger.info(f"Training on device: {device}")
-    model, criterion = model.to(device), criterion.to(device)
 
-    results = train_model(train_dl, val_dl, n_epochs, model,
-                          criterion, optimizer, device, ds.labels)
+def init_distributed(rank: int, world_size: int) -> None:
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # The cores of the machine are split between its processes, whose
+    # number torchrun sets in LOCAL_WORLD_SIZE
+    local_procs = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+    torch.set_num_threads(max(1, os.cpu_count() // local_procs))
+
 
+def save_results(model: SimpleNN, vectorizer: BaseEstimator,
+                 results: Dict[str, Any], labels: List[str],
+                 model_path: Path) -> None:
+    """Saves the weights, the architecture and the vectorizer of the
+    model (see `export_nn_model`), its results and their plots"""
+    logger = logging.getLogger('ml-model')
     torch.save(model.state_dict(), model_path / "nn_model.pt")
+    with open(model_path / "nn_config.json", "w") as f:
+        json.dump(model.config, f, indent=4)
+    dump(vectorizer, model_path / "nn_vectorizer.joblib")
 
     with open(model_path / 'nn_results.pkl', 'wb') as f:
         pickle.dump(results, f)
@@ -63,12 +152,89 @@ def main(csv_path: str,
     plot_loss_acc(results, fn=model_path / 'nn_loss.png')
 
     logger.info("Plotting last confusion matrix results")
-    plot_cm_nn(results, labels=ds.labels, fn=model_path / 'nn_cm.png')
+    plot_cm_nn(results, labels=labels, fn=model_path / 'nn_cm.png')
+
+
+def train(rank: int, world_size: int, config: Dict[str, Any]) -> None:
+    """Trains the model in one process, the rank `rank` of
+    `world_size` processes, see `main`"""
+    start_time = time.time()
+    logger = logging.getLogger('ml-model')
+    distributed = world_size > 1
+    if distributed:
+        init_distributed(rank, world_size)
+    if rank > 0:
+        # Only the first process logs
+        logger.setLevel(logging.WARNING)
+    logger.info("Begin training on Deep learning model")
+    if distributed:
+        logger.info(f"Distributed training on {world_size} processes "
+                    f"with {torch.get_num_threads()} thread(s) each")
+    # Same seed in every process, for the same split of the dataset
+    torch.manual_seed(config["seed"])
+
+    model_path = config["model_path"]
+    bs = config["bs"]
+    hidden_sizes = config["hidden_sizes"]
+    input_mode = config["input_mode"]
+
+    ds = CommentDataset(config["csv_path"],
+                        vectorizer=config["vectorizer"],
+                        n_features=config["n_features"],
+                        cache_dir=config["cache_dir"])
+    n_words = ds.n_features
+    logger.info(f"Loaded dataset of {len(ds)} samples.")
+    if ds.cache_path is not None:
+        logger.info(f"Features cached in {ds.cache_path}")
+    logger.info(f"Dataset labels: {ds.labels}")
+    logger.info(f"N° of words: {n_words}")
+
+    device = torch.device("cuda" if torch.cuda.is_available()
+                          and not distributed else "cpu")
+    logger.info(f"Loading dataloaders with batch sizes {bs}"
+                + (" per process" if distributed else ""))
+    train_dl, val_dl = get_dataloaders(ds, bs, train_size=0.8,
+                                       num_workers=config["num_workers"],
+                                       pin_memory=device.type == "cuda",
+                                       rank=rank, world_size=world_size)
+
+    logger.info(f"Loading NN model with input {n_words}, output 2, "
+                f"hidden layers {hidden_sizes} and {input_mode} input")
+    model = SimpleNN(n_words, 2, hidden_sizes=hidden_sizes,
+                     input_mode=input_mode)
+    criterion = nn.CrossEntropyLoss()
+    logger.info(f"Training on device: {device}")
+    model, criterion = model.to(device), criterion.to(device)
+    net = model
+    if distributed:
+        # The weights of the rank 0 are broadcast, the dropout masks
+        # must differ between the processes
+        net = DistributedDataParallel(model)
+        torch.manual_seed(config["seed"] + rank)
+    optimizer = optim.Adam(net.parameters(), lr=1e-3)
+
+    checkpoint_path = None
+    if config["checkpoint_every"] > 0 or config["resume"]:
+        checkpoint_path = model_path / "nn_checkpoint.pt"
+    results = train_model(train_dl, val_dl, config["n_epochs"], net,
+                          criterion, optimizer, device, ds.labels,
+                          eval_every=config["eval_every"],
+                          checkpoint_path=checkpoint_path,
+                          checkpoint_every=(config["checkpoint_every"]
+                                            or config["n_epochs"]),
+                          resume=config["resume"],
+                          patience=config["patience"],
+                          best_path=(model_path / "nn_best.pt"
+                                     if checkpoint_path else None))
 
-    end_time = time.time()
-    tot_time = str(dt.timedelta(seconds=end_time-start_time))
-    h, mn, s = tot_time.split(":")
-    logger.info(f"Script ended in {h}h, {mn}min and {s}s")
+    if rank == 0:
+        save_results(model, ds.vectorizer, results, ds.labels, model_path)
+        end_time = time.time()
+        tot_time = str(dt.timedelta(seconds=end_time-start_time))
+        h, mn, s = tot_time.split(":")
+        logger.info(f"Script ended in {h}h, {mn}min and {s}s")
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
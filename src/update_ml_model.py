@@ -0,0 +1,124 @@
+import click
+import logging
+import time
+import datetime as dt
+import coloredlogs
+import numpy as np
+from pathlib import Path
+from typing import Optional
+from sklearn.pipeline import Pipeline
+from src.features.build_features import CleanerTransformer, HashingTfidf
+from src.models.ml_model import (STREAMING_CLASSIFIERS, make_streaming_model,
+                                 partial_fit_model)
+from src.models.serving import (dump_model, has_cleaner, load_model,
+                                with_cleaner)
+from src.predict import read_chunks
+
+
+def check_updatable(model: Pipeline, name: Optional[str]) -> None:
+    """Checks that a pipeline ends with a hashing vectorizer and a
+    classifier which can be trained by batch"""
+    if not isinstance(model.steps[-2][1], HashingTfidf):
+        raise click.ClickException(
+            f"{name} has no hashing vectorizer, it can't be updated")
+    clf = model.steps[-1][1]
+    if not hasattr(clf, "partial_fit"):
+        raise click.ClickException(
+            f"{type(clf).__name__} can't be trained by batch (no "
+            f"partial_fit), {name} can't be updated")
+
+
+@click.command()
+@click.argument('csv_path', type=click.Path(exists=True))
+@click.argument('model_path', type=click.Path())
+@click.option("--base-model", "-bm", "base_model",
+              type=click.Path(exists=True), default=None,
+              help=("Hashing pipeline to update (a new one is trained "
+                    "otherwise)"))
+@click.option("--classifier", "-c", "classifier",
+              type=click.Choice(list(STREAMING_CLASSIFIERS)), default="sgd",
+              help="Classifier of a new pipeline")
+@click.option("--n-features", "-nf", "n_features", type=int,
+              default=2 ** 18,
+              help="Number of columns of the hashing vectorizer")
+@click.option("--chunksize", "-cs", type=int, default=10000,
+              help="Number of comments read and learned at once")
+@click.option("--freeze-idf/--update-idf", default=False,
+              help="Keeps the IDF weights of the base model")
+@click.option("--labels", "-l", "labels", multiple=True,
+              default=["Negative", "Positive"],
+              help="Labels of the comments, in the order of the classes")
+@click.option("--fuse-cleaner/--no-fuse-cleaner", default=True,
+              help="Saves the cleaner in a new pipeline")
+def main(csv_path: str,
+         model_path: str,
+         base_model: Optional[str] = None,
+         classifier: str = "sgd",
+         n_features: int = 2 ** 18,
+         chunksize: int = 10000,
+         freeze_idf: bool = False,
+         labels: tuple = ("Negative", "Positive"),
+         fuse_cleaner: bool = True
+         ) -> None:
+    """ Trains a hashing TF-IDF model on the cleaned comments of
+        CSV_PATH (`x` and `y` columns) out-of-core, or updates the
+        one of --base-model with them, and saves it at MODEL_PATH.
+
+        The CSV is streamed by chunks: the document frequencies and
+        the classifier are updated chunk by chunk with `partial_fit`,
+        so the memory used depends on the chunk size and on the
+        number of columns, not on the size of the CSV. Each chunk is
+        scored before being learned (progressive validation).
+    """
+    logger = logging.getLogger('ml-model')
+    start_time = time.time()
+    if base_model:
+        model = load_model(base_model)
+        logger.info(f"Updating {base_model}")
+    else:
+        model = make_streaming_model(classifier, n_features)
+        logger.info(f"Training a new {classifier} model on "
+                    f"{n_features} hashed features")
+    check_updatable(model, base_model)
+    # The comments of the CSV are already cleaned
+    cleaner = None
+    if has_cleaner(model):
+        cleaner, model = model.steps[0][1], model[1:]
+    elif fuse_cleaner and not base_model:
+        cleaner = CleanerTransformer().fit()
+    classes = np.arange(len(labels))
+    labels = list(labels)
+
+    n_seen, n_scored, n_correct = 0, 0, 0
+    for chunk in read_chunks(Path(csv_path), chunksize):
+        chunk = chunk.dropna(subset=["x", "y"])
+        X = chunk.x.astype(str).values
+        y = chunk.y.apply(labels.index).values
+        if n_seen or base_model:
+            n_correct += int((model.predict(X) == y).sum())
+            n_scored += len(y)
+        partial_fit_model(model, X, y, classes,
+                          update_idf=not freeze_idf)
+        n_seen += len(y)
+        logger.info(f"{n_seen} comments learned")
+
+    if n_seen == 0:
+        raise click.ClickException(f"No comment in {csv_path}")
+    if n_scored:
+        logger.info(f"Progressive accuracy: {n_correct / n_scored:.4f} "
+                    f"on {n_scored} comments")
+
+    if cleaner is not None:
+        model = with_cleaner(model, cleaner)
+    dump_model(model, model_path)
+    logger.info(f"Model saved at {model_path}")
+    elapsed = time.time() - start_time
+    logger.info(f"{n_seen} comments in {dt.timedelta(seconds=elapsed)}")
+
+
+if __name__ == "__main__":
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    coloredlogs.install()
+
+    main()
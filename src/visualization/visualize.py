@@ -54,15 +54,19 @@ def plot_loss_acc(res_dict, fn=None):
     train_acc = [rep_ep["accuracy"] for rep_ep in res_dict["train"]["report"]]
     val_acc = [rep_ep["accuracy"] for rep_ep in res_dict["val"]["report"]]
 
+    # The validation set may be evaluated every few epochs only
+    train_epochs = res_dict["train"].get("epoch", range(len(train_loss)))
+    val_epochs = res_dict["val"].get("epoch", range(len(val_loss)))
+
     fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(12, 6))
-    ax1.plot(train_loss, label="Loss (train)")
-    ax1.plot(val_loss, label="Loss (val)")
+    ax1.plot(train_epochs, train_loss, label="Loss (train)")
+    ax1.plot(val_epochs, val_loss, label="Loss (val)")
     ax1.set_ylabel("Loss value")
     ax1.set_xlabel("Epoch")
     ax1.legend()
 
-    ax2.plot(train_acc, label="Accuracy (train)")
-    ax2.plot(val_acc, label="Accuracy (val)")
+    ax2.plot(train_epochs, train_acc, label="Accuracy (train)")
+    ax2.plot(val_epochs, val_acc, label="Accuracy (val)")
     ax2.set_ylabel("Accuracy")
     ax2.set_xlabel("Epoch")
     ax2.legend()